@@ -7,10 +7,13 @@ from datetime import datetime, timedelta
 import logging
 from operator import itemgetter
 from logging.config import dictConfig
+from functools import partial
 from collections import defaultdict
 
 import click
 import tushare
+import pandas as pd
+from peewee import fn
 
 from keysersoze.data import (
     QiemanExporter,
@@ -23,12 +26,22 @@ from keysersoze.models import (
     AssetMarketHistory,
     AccountHistory,
     AccountAssetsHistory,
+    AccountAssetValueHistory,
     QiemanAsset,
+    AccountWatermark,
+    AssetPriceVersion,
+    CalendarDay,
+    PRICE_BOOK,
+    PRICE_STORE,
 )
+from keysersoze.fetcher import Fetcher
+from keysersoze.migrations import migrate
+from keysersoze.parsers import PARSERS, parse_statements
+from keysersoze.trading_calendar import TRADING_CALENDAR, to_date
 from keysersoze.utils import (
-    get_code_suffix,
+    bulk_import_deals,
     update_account_assets_history,
-    compute_account_history,
+    update_account_history,
 )
 
 
@@ -68,12 +81,71 @@ def main():
     pass
 
 
+# 订单达到这些状态后不会再变化，其他状态（如确认中）的订单在下次导出时重新获取
+FINAL_ORDER_STATUSES = {'SUCCESS', 'FAIL', 'FAILED', 'CANCEL', 'CANCELED', 'CANCELLED', 'CLOSED'}
+
+
+def load_exported_orders(path):
+    """读取导出的订单文件，返回 ({orderId: 订单}, 最后一个完整行的结束位置)
+
+    导出中断时文件末尾可能有一行没有写完，续写前需要截断到返回的位置。
+    """
+    orders, size = {}, 0
+    if not os.path.exists(path):
+        return orders, size
+
+    with open(path, 'rb') as fin:
+        for lineno, line in enumerate(fin, 1):
+            if not line.endswith(b'\n'):
+                LOGGER.warning("drop incomplete line %d of %s", lineno, path)
+                break
+
+            size += len(line)
+            try:
+                order = json.loads(line)
+                orders[order['orderId']] = order
+            except (ValueError, KeyError):
+                LOGGER.warning("could not read orderId from line %d of %s", lineno, path)
+
+    return orders, size
+
+
+def is_final_order(order):
+    return order.get('orderStatus', 'SUCCESS') in FINAL_ORDER_STATUSES
+
+
+def save_checkpoints(checkpoint_file, checkpoints):
+    tmp_file = f'{checkpoint_file}.tmp'
+    with open(tmp_file, 'w') as fout:
+        json.dump(checkpoints, fout, indent=2, sort_keys=True)
+
+    os.replace(tmp_file, checkpoint_file)
+
+
+def save_orders(outfile, orders):
+    """按时间从新到旧写入全部订单"""
+    orders = sorted(orders, key=lambda order: -order.get('acceptTime', 0))
+    tmp_file = f'{outfile}.tmp'
+    with open(tmp_file, 'w') as fout:
+        for order in orders:
+            print(json.dumps(order, ensure_ascii=False, sort_keys=True), file=fout)
+
+    os.replace(tmp_file, outfile)
+
+
 @main.command("export-qieman-orders")
 @click.option("-c", "--config-file", required=True)
 @click.option("-o", "--outfile", required=True)
 @click.option("-n", "--asset-name", required=True)
-def export_qieman_orders(config_file, asset_name, outfile):
-    """导出且慢订单记录"""
+@click.option("--full", is_flag=True, help="重新导出全部订单，替换已有的输出文件")
+def export_qieman_orders(config_file, asset_name, outfile, full):
+    """导出且慢订单记录
+
+    默认只获取输出文件中还没有的订单以及状态还没有确定的订单，与已有订单合并后按时间排序写回。
+    每次导出完成后，在 `<outfile>.checkpoint` 中记录各资产已导出的最新订单，
+    下次导出翻页到该订单（或更早的未确定订单）时停止。获取到的订单先逐条写入 `<outfile>.partial`，
+    导出中断时再次执行会跳过其中的订单继续导出。
+    """
     asset = QiemanAsset.get_or_none(name=asset_name)
     if asset is None:
         LOGGER.warning("could not find Qieman asset with name `%s`", asset_name)
@@ -82,293 +154,100 @@ def export_qieman_orders(config_file, asset_name, outfile):
     with open(config_file) as f:
         config = json.load(f)
         exporter = QiemanExporter(**config)
-        orders = exporter.list_orders(asset.asset_id)
 
-    with open(outfile, 'w') as fout:
+    asset_key = str(asset.asset_id)
+    checkpoint_file, partial_file = f'{outfile}.checkpoint', f'{outfile}.partial'
+    checkpoints = {}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoints = json.load(f)
+
+    if full:
+        exported, size = {}, 0
+        # 全量导出中途中断时，旧的记录不能再作为增量导出的起点
+        if checkpoints.pop(asset_key, None):
+            save_checkpoints(checkpoint_file, checkpoints)
+    else:
+        exported, _ = load_exported_orders(outfile)
+        fetched, size = load_exported_orders(partial_file)
+        exported.update(fetched)
+
+    checkpoint = checkpoints.get(asset_key) if exported else None
+    since = checkpoint['accept_time'] if checkpoint else None
+    unsettled = [order for order in exported.values() if not is_final_order(order)]
+    if since is not None and unsettled:
+        since = min([since] + [order.get('acceptTime', since) for order in unsettled])
+
+    settled = set(order_id for order_id, order in exported.items() if is_final_order(order))
+    orders = exporter.list_orders(asset.asset_id, exported=settled, since=since)
+
+    new_orders = {}
+    with open(partial_file, 'a') as fout:
+        fout.truncate(size)
         for order in orders:
             line = json.dumps(order, ensure_ascii=False, sort_keys=True)
-            print(line, file=fout)
-
-
-@main.command("parse-qieman")
-@click.option("-i", "--infile", required=True)
-@click.option("-o", "--outfile", required=True)
-@click.option("--add-transfer", is_flag=True, help="是否在买入时自动产生一笔等额资金转入")
-def parse_qieman_orders(infile, outfile, add_transfer):
-    """解析且慢订单记录为 csv 格式"""
-    results = []
-    with open(infile) as fin:
-        pattern = re.compile(r'再投资份额(\d+\.\d+)份')
-        unknown_buyings, transfer_in = [], defaultdict(float)
-        for line in fin:
-            item = json.loads(line)
-            account = item['umaName']
-            sub_account = item['capitalAccountName']
-            if item['capitalAccountName'] == '货币三佳':
-                pass
-            elif item['hasDetail']:
-                if item['orderStatus'] != 'SUCCESS':
-                    continue
-
-                for order in item['compositionOrders']:
-                    value = order['nav']
-                    fee = order['fee']
-                    order_time = datetime.fromtimestamp(order['acceptTime'] / 1000)
-                    count = order['uiShare']
-                    money = order['uiAmount']
-                    action = 'unknown'
-                    if order['payStatus'] == '2':
-                        action = 'buy'
-                    elif order['payStatus'] == '0':
-                        action = 'sell'
-
-                    fund_code = order['fund']['fundCode']
-                    fund_name = order['fund']['fundName']
-                    if fund_name.find('广发钱袋子') >= 0:  # FIXME: 应当用基金类型来判断
-                        continue
-
-                    if 'destFund' in order:
-                        money -= fee
-                        unknown_buyings.append([
-                            account, sub_account, order_time,
-                            order['destFund']['fundCode'], order['destFund']['fundName'],
-                            money
-                        ])
-                    elif add_transfer and action == 'buy':
-                        transfer_in[(account, str(order_time.date()))] += money
-
-                    results.append([
-                        account, sub_account, order_time, fund_code, fund_name,
-                        action, count, value, money, fee
-                    ])
-            elif item['uiOrderDesc'].find('再投资') >= 0:
-                fee = 0
-                order_time = datetime.fromtimestamp(item['acceptTime'] / 1000)
-                count = float(pattern.findall(item['uiOrderDesc'])[0])
-                money = item['uiAmount']
-                value = round(float(money) / float(count), 4)
-                action = 'reinvest'
-                fund_code = item['fund']['fundCode']
-                fund_name = item['fund']['fundName']
-                # 且慢交易记录里红利再投资日期是再投资到账日期，不是实际发生的日期，
-                # 这里尝试根据净值往前查找得到真正的日期
-                fund = Asset.get_or_none(code=f'{fund_code}.OF')
-                if fund:
-                    search = fund.history.where(AssetMarketHistory.date < order_time.date())
-                    search = search.where(
-                        AssetMarketHistory.date >= order_time.date() - timedelta(days=10)
-                    )
-                    search = search.order_by(AssetMarketHistory.date.desc())
-                    candidates = []
-                    for record in search[:3]:
-                        candidates.append((record, abs(record.nav - value)))
-
-                    record, nav_diff = min(candidates, key=itemgetter(1))
-                    LOGGER.info(
-                        "correct reinvestment time of `%s` from `%s` to `%s`(nav diff: %f)",
-                        fund_code, order_time, record.date, nav_diff
-                    )
-                    value = record.nav
-                    order_time = datetime.strptime(f'{record.date} 08:00:00', '%Y-%m-%d %H:%M:%S')
-                else:
-                    LOGGER.warning(
-                        "can not guess real order time of reinvestment(code: %s;time: %s; nav: %s)",
-                        fund_code, order_time, value
-                    )
-
-                results.append([
-                    account, sub_account, order_time, fund_code, fund_name,
-                    action, count, value, money, fee
-                ])
-            elif item['uiOrderCodeName'].find('现金分红') >= 0:
-                order_time = datetime.fromtimestamp(item['acceptTime'] / 1000)
-                results.append([
-                    account, sub_account, order_time,
-                    item['fund']['fundCode'], item['fund']['fundName'],
-                    'bonus', item['uiAmount'], 1.0, item['uiAmount'], 0.0
-                ])
-
-        for (account, date), money in transfer_in.items():
-            order_time = datetime.strptime(f'{date} 08:00:00', '%Y-%m-%d %H:%M:%S')
-            results.append([
-                account, '', order_time, 'CASH', '现金',
-                'transfer_in', money, 1.0, money, 0.0
-            ])
+            print(line, file=fout, flush=True)
+            new_orders[order['orderId']] = order
+
+            accept_time = order.get('acceptTime')
+            if accept_time is not None and (
+                    checkpoint is None or accept_time > checkpoint['accept_time']
+            ):
+                checkpoint = {'accept_time': accept_time, 'order_id': order['orderId']}
+
+    exported.update(new_orders)
+    save_orders(outfile, exported.values())
+    os.remove(partial_file)
+    if checkpoint:
+        checkpoints[asset_key] = checkpoint
+        save_checkpoints(checkpoint_file, checkpoints)
+
+    LOGGER.info(
+        "exported %d new or updated orders of `%s` into %s", len(new_orders), asset_name, outfile
+    )
 
-        for account, sub_account, order_time, code, name, money in unknown_buyings:
-            fund = Asset.get_or_none(zs_code=f'{code}.OF')
-            if not fund:
-                LOGGER.warning(
-                    "fund `%s` is not found in database, add it with `update-fund`",
-                    code
-                )
-                continue
 
-            close_time = datetime.strptime(f'{order_time.date()} 15:00:00', '%Y-%m-%d %H:%M:%S')
-            if order_time > close_time:
-                history_date = order_time.replace(days=1).date()
-            else:
-                history_date = order_time.date()
+def run_parsers(broker, infiles, outfile, workers, **options):
+    count = parse_statements(broker, infiles, outfile, workers=workers, **options)
+    LOGGER.info("wrote %d deals parsed from %d files into %s", count, len(infiles), outfile)
 
-            history_records = list(fund.history.where(AssetMarketHistory.date == history_date))
-            if not history_records:
-                LOGGER.warning(
-                    "history data of fund `%s` is not found in database, try `update-fund`",
-                    code
-                )
-                continue
 
-            value = history_records[0].nav
-            count = round(money / value, 2)
-            results.append([
-                account, sub_account, order_time, code, name,
-                'buy', count, value, money, 0.0
-            ])
+@main.command("parse-deals")
+@click.option("-b", "--broker", type=click.Choice(sorted(PARSERS)), required=True)
+@click.option("-i", "--infile", "infiles", required=True, multiple=True, help="可以指定多次")
+@click.option("-o", "--outfile", required=True)
+@click.option("-w", "--workers", type=int, help="并行解析多个输入文件的进程数")
+def parse_deals(broker, infiles, outfile, workers):
+    """用指定券商的解析器将交易记录解析为 import-deals 使用的格式"""
+    run_parsers(broker, infiles, outfile, workers)
 
-    results.sort(key=itemgetter(2, 0, 1, 3, 5))
-    with open(outfile, 'w') as fout:
-        for row in results:
-            if row[3] != 'CASH':
-                row[3] = row[3] + '.OF'
 
-            line = '\t'.join([
-                '\t'.join(map(str, row[:6])),
-                f'{row[6]:0.2f}', f'{row[7]:0.4f}',
-                '\t'.join([f'{r:.2f}' for r in row[8:]]),
-            ])
-            print(line, file=fout)
+@main.command("parse-qieman")
+@click.option("-i", "--infile", "infiles", required=True, multiple=True, help="可以指定多次")
+@click.option("-o", "--outfile", required=True)
+@click.option("--add-transfer", is_flag=True, help="是否在买入时自动产生一笔等额资金转入")
+@click.option("-w", "--workers", type=int, help="并行解析多个输入文件的进程数")
+def parse_qieman_orders(infiles, outfile, add_transfer, workers):
+    """解析且慢订单记录为 csv 格式"""
+    run_parsers('qieman', infiles, outfile, workers, add_transfer=add_transfer)
 
 
 @main.command("parse-pingan")
-@click.option("-i", "--infile", required=True)
+@click.option("-i", "--infile", "infiles", required=True, multiple=True, help="可以指定多次")
 @click.option("-o", "--outfile", required=True)
-def parse_pingan(infile, outfile):
+@click.option("-w", "--workers", type=int, help="并行解析多个输入文件的进程数")
+def parse_pingan(infiles, outfile, workers):
     """解析平安证券的交易记录"""
-    action_mappings = {
-        '证券买入': 'buy',
-        '证券卖出': 'sell',
-        '银证转入': 'transfer_in',
-        '银证转出': 'transfer_out',
-        '利息归本': 'reinvest',
-    }
-    results = []
-    with open(infile) as fin:
-        reader = csv.DictReader(fin)
-        for row in reader:
-            if row['操作'] not in action_mappings:
-                LOGGER.warning("unsupported action: %s", row['操作'])
-                continue
-
-            order_time = datetime.strptime(f'{row["成交日期"]} {row["成交时间"]}', '%Y%m%d %H:%M:%S')
-            action = action_mappings[row['操作']]
-            code, name = row['证券代码'], row['证券名称']
-            count, price = float(row['成交数量']), float(row['成交均价'])
-            money = float(row['发生金额'].lstrip('-'))
-            fee = float(row["手续费"]) + float(row["印花税"])
-            if action.startswith('transfer') or action == 'reinvest':
-                code, name, count, price = 'CASH', '现金', money, 1.0
-
-            if code != 'CASH':
-                suffix = get_code_suffix(code)
-                code = f'{code}.{suffix}'
-
-            results.append([
-                '平安证券', '平安证券', order_time, code, name,
-                action, count, price, money, fee
-            ])
-
-    results.sort(key=itemgetter(2, 3, 5))
-    with open(outfile, 'w') as fout:
-        for row in results:
-            line = '\t'.join([
-                '\t'.join(map(str, row[:6])),
-                f'{row[6]:0.2f}', f'{row[7]:0.4f}',
-                '\t'.join([f'{r:0.2f}' for r in row[8:]]),
-            ])
-            print(line, file=fout)
+    run_parsers('pingan', infiles, outfile, workers)
 
 
 @main.command("parse-huabao")
-@click.option("-i", "--infile", required=True)
+@click.option("-i", "--infile", "infiles", required=True, multiple=True, help="可以指定多次")
 @click.option("-o", "--outfile", required=True)
-def parse_huabao(infile, outfile):
+@click.option("-w", "--workers", type=int, help="并行解析多个输入文件的进程数")
+def parse_huabao(infiles, outfile, workers):
     """解析华宝证券的交易记录"""
-    ignore_actions = set(['中签通知', '配号'])
-    action_mappings = {
-        '买入': 'buy',
-        '卖出': 'sell',
-        '中签扣款': 'buy',
-    }
-    data = []
-    stagging_data = []
-    with open(infile) as fin:
-        reader = csv.DictReader(fin)
-        for row in reader:
-            if row['委托类别'] in ignore_actions:
-                continue
-
-            if row['委托类别'] not in action_mappings:
-                # 将打新股/打新债的扣款、托管相关的交易记录另外记录待之后处理
-                if row['委托类别'] in ('托管转入', '托管转出'):
-                    stagging_data.append(row)
-                    continue
-                else:
-                    LOGGER.warning("unsupported action: %s", row)
-
-                continue
-
-            order_time = datetime.strptime(f'{row["成交日期"]} {row["成交时间"]}', '%Y%m%d %H:%M:%S')
-            action = action_mappings[row['委托类别']]
-            money, fee = float(row['发生金额']), float(row['佣金']) + float(row['印花税'])
-            if action == 'buy':
-                money += fee
-            elif action == 'sell':
-                money -= fee
-
-            # 有些品种用「手」作为单位，将其转换为「股」
-            count, price = float(row['成交数量']), float(row['成交价格'])
-            if abs(money / (float(count) * float(price)) - 10) < 0.5:
-                count = float(count) * 10
-
-            code, name = row['证券代码'], row['证券名称']
-            if row['委托类别'] != '中签扣款':
-                suffix = get_code_suffix(code)
-                code = f'{code}.{suffix}'
-
-            data.append((
-                '华宝证券', '华宝证券', order_time, code, name,
-                action, count, price, money, fee
-            ))
-
-    name2codes = defaultdict(dict)
-    for row in stagging_data:
-        if not row['证券名称'].strip():
-            continue
-
-        if row['委托类别'] == '托管转出' and row['成交编号'] == '清理过期数据':
-            name2codes[row['证券名称']]['origin'] = row['证券代码']
-        elif row['委托类别'] == '托管转入':
-            suffix = get_code_suffix(row['证券代码'])
-            name2codes[row['证券名称']]['new'] = row['证券代码'] + f'.{suffix}'
-
-    code_mappings = {}
-    for codes in name2codes.values():
-        code_mappings[codes['origin']] = codes['new']
-
-    data.sort(key=itemgetter(2, 3, 5))
-    with open(outfile, 'w') as fout:
-        for row in data:
-            row = list(row)
-            if row[5] == 'buy' and row[3] in code_mappings:
-                LOGGER.info("convert code from `%s` to `%s`", row[4], code_mappings[row[3]])
-                row[3] = code_mappings[row[3]]
-
-            line = '\t'.join([
-                '\t'.join(map(str, row[:6])),
-                f'{row[6]:0.2f}', f'{row[7]:0.4f}',
-                '\t'.join([f'{r:0.2f}' for r in row[8:]]),
-            ])
-            print(line, file=fout)
+    run_parsers('huabao', infiles, outfile, workers)
 
 
 @main.command("create-db")
@@ -381,11 +260,33 @@ def create_db():
         AssetMarketHistory,
         AccountHistory,
         AccountAssetsHistory,
+        AccountAssetValueHistory,
+        AccountWatermark,
+        AssetPriceVersion,
+        CalendarDay,
         QiemanAsset,
     ])
+    migrate()
     DATABASE.close()
 
 
+@main.command("migrate-db")
+def migrate_db():
+    """将已有的数据库升级到最新的表结构"""
+    DATABASE.connect()
+    applied = migrate()
+    DATABASE.close()
+    LOGGER.info('applied %d migrations', applied)
+
+
+@main.command("sync-price-store")
+def sync_price_store():
+    """从数据库重建本地的列式行情缓存，之后 update-prices 会保持同步"""
+    count = PRICE_STORE.sync_all()
+    PRICE_BOOK.invalidate()
+    LOGGER.info('synced %d assets into %s', count, PRICE_STORE.directory)
+
+
 @main.command('add-asset')
 @click.option('--zs-code', required=True)
 @click.option('--code', required=True)
@@ -475,11 +376,141 @@ def init_assets():
         )
 
 
+EASTMONEY_RATE = 120  # 每分钟请求天天基金的次数
+TUSHARE_COLUMNS = {
+    'date': 'date',
+    'open': 'open_price',
+    'close': 'close_price',
+    'pre_close': 'pre_close',
+    'change': 'change',
+    'pct_chg': 'pct_change',
+    'vol': 'vol',
+    'amount': 'amount',
+    'high': 'high_price',
+    'low': 'low_price',
+}
+
+
+def parse_tushare_history(frames):
+    """将 tushare 返回的行情 DataFrame 转换为按 TUSHARE_COLUMNS 中字段顺序排列的元组列表"""
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return []
+
+    data = pd.concat(frames, ignore_index=True).drop_duplicates('trade_date')
+    data['date'] = pd.to_datetime(data['trade_date'], format='%Y%m%d').dt.date
+    data = data.rename(columns=TUSHARE_COLUMNS)[list(TUSHARE_COLUMNS.values())]
+    data = data.astype(object).where(data.notna(), None)
+    return list(data.itertuples(index=False, name=None))
+
+
+def parse_fund_history(fund_data):
+    """将天天基金的净值数据转换为 (date, nav, auv, bonus_action, bonus_value) 的列表"""
+    history = defaultdict(dict)
+    for nav in fund_data['Data_netWorthTrend']:
+        date = datetime.fromtimestamp(nav['x'] / 1000).date()
+        history[date]['nav'] = nav['y']
+        if nav.get('unitMoney'):
+            bonus_text = nav['unitMoney']
+            action, value = 'unknown', None
+            if bonus_text.startswith('分红'):
+                action = 'bonus'
+                value = float(re.findall(r'派现金(\d\.\d+)元', bonus_text)[0])
+            elif bonus_text.startswith('拆分'):
+                action = 'spin_off'
+                value = float(re.findall(r'折算(\d\.\d+)份', bonus_text)[0])
+            else:
+                LOGGER.warning("unknown bonus text: %s", bonus_text)
+
+            if action != 'unknown':
+                history[date]['bonus_action'] = action
+                history[date]['bonus_value'] = value
+
+    for auv in fund_data['Data_ACWorthTrend']:
+        date = datetime.fromtimestamp(auv[0] / 1000).date()
+        history[date]['auv'] = auv[1]
+
+    rows = []
+    for date, info in sorted(history.items()):
+        if 'nav' not in info:
+            LOGGER.warning("invalid history data: %s(%s)", info, date)
+            continue
+
+        rows.append((
+            date, info['nav'], info.get('auv'), info.get('bonus_action'), info.get('bonus_value')
+        ))
+
+    return rows
+
+
+FUND_COLUMNS = ['date', 'nav', 'auv', 'bonus_action', 'bonus_value']
+
+
+def fetch_tushare_history(fetcher, method, zs_code, start_date, end_date):
+    """分段获取 tushare 行情，每段最多 1000 天，返回 (字段, 记录)"""
+    frames = []
+    days = (end_date - start_date).days + 1
+    for offset in range(0, days, 1000):
+        cur_start_date = start_date + timedelta(days=offset)
+        cur_end_date = min(cur_start_date + timedelta(days=1000), end_date)
+        frames.append(fetcher.call(
+            'tushare', method,
+            ts_code=zs_code,
+            start_date=cur_start_date.strftime('%Y%m%d'),
+            end_date=cur_end_date.strftime('%Y%m%d')
+        ))
+
+    return list(TUSHARE_COLUMNS.values()), parse_tushare_history(frames)
+
+
+def fetch_fund_history(fetcher, api, fund_code):
+    """获取场外基金的全部净值，返回 (字段, 记录)，没有数据时返回 None"""
+    fund_data = fetcher.call('eastmoney', api.get_fund_data, fund_code)
+    if fund_data is None:
+        return None
+
+    return FUND_COLUMNS, parse_fund_history(fund_data)
+
+
+def get_fetch_start_dates(assets, default_date):
+    """计算每个资产需要获取行情的起始日期
+
+    已有行情的资产从最后一个行情日期的下一天开始，已经是最新的资产不会再发起请求；
+    没有行情的资产从第一笔交易的日期开始补全，没有交易的资产（如指数）从所有交易中
+    最早的日期开始，仍然没有时使用 `default_date`。
+    """
+    codes = [asset.zs_code for asset in assets]
+    search = AssetMarketHistory.select(AssetMarketHistory.asset, fn.MAX(AssetMarketHistory.date)).\
+        where(AssetMarketHistory.asset.in_(codes)).\
+        group_by(AssetMarketHistory.asset)
+    last_dates = dict(search.tuples())
+
+    search = Deal.select(Deal.asset, fn.MIN(Deal.time)).\
+        where(Deal.asset.in_(codes)).\
+        group_by(Deal.asset)
+    first_deal_dates = {code: to_date(deal_time) for code, deal_time in search.tuples()}
+
+    first_deal_time = Deal.select(fn.MIN(Deal.time)).scalar()
+    if first_deal_time is not None:
+        default_date = to_date(first_deal_time)
+
+    start_dates = {}
+    for code in codes:
+        if code in last_dates:
+            start_dates[code] = last_dates[code] + timedelta(days=1)
+        else:
+            start_dates[code] = first_deal_dates.get(code, default_date)
+
+    return start_dates
+
+
 @main.command('update-prices')
 @click.option('--category', type=click.Choice(['index', 'stock', 'fund', 'bond']))
 @click.option('--codes')
-@click.option('--start-date')
-def update_prices(category, codes, start_date):
+@click.option('--start-date', help="所有资产统一从该日期开始获取，默认只获取各资产缺少的部分")
+@click.option('--workers', type=int, default=8, help="并发请求数")
+@click.option('--tushare-rate', type=int, default=200, help="每分钟最多请求 tushare 的次数")
+def update_prices(category, codes, start_date, workers, tushare_rate):
     '''更新交易记录涉及到的资产的历史价格'''
     token = os.environ.get('TS_TOKEN')
     if not token:
@@ -507,9 +538,7 @@ def update_prices(category, codes, start_date):
             assets.extend(list(Asset.select().where(Asset.category == 'index')))
 
     now = datetime.now()
-    if start_date is None:
-        start_date = (now - timedelta(days=10)).date()
-    else:
+    if start_date is not None:
         start_date = datetime.strptime(start_date, '%Y%m%d').date()
 
     if now.hour >= 15:
@@ -525,136 +554,91 @@ def update_prices(category, codes, start_date):
         'fund': client.fund_daily,
         'index': client.index_daily
     }
+    fetcher = Fetcher(
+        {'tushare': (tushare_rate, 5), 'eastmoney': (EASTMONEY_RATE, 5)},
+        max_workers=workers,
+    )
+    start_dates = get_fetch_start_dates(assets, default_date=(now - timedelta(days=10)).date())
+    jobs = []
     for asset in assets:
-        created_cnt = 0
+        cur_start_date = start_date or start_dates[asset.zs_code]
+        if cur_start_date > end_date:
+            LOGGER.info('history of %s(%s) is up to date', asset.name, asset.zs_code)
+            continue
+
         if asset.category in ('stock', 'bond', 'index') or \
            (asset.category == 'fund' and not asset.zs_code.endswith('OF')):
-            days = (end_date - start_date).days + 1
-            method = methods[asset.category]
-            for offset in range(0, days, 1000):
-                cur_start_date = start_date + timedelta(days=offset)
-                cur_end_date = min(cur_start_date + timedelta(days=1000), end_date)
-                data = method(
-                    ts_code=asset.zs_code,
-                    start_date=cur_start_date.strftime('%Y%m%d'),
-                    end_date=cur_end_date.strftime('%Y%m%d')
-                )
-                for _, row in data.iterrows():
-                    _, created = AssetMarketHistory.get_or_create(
-                        date=datetime.strptime(row['trade_date'], '%Y%m%d').date(),
-                        open_price=row['open'],
-                        close_price=row['close'],
-                        pre_close=row['pre_close'],
-                        change=row['change'],
-                        pct_change=row['pct_chg'],
-                        vol=row['vol'],
-                        amount=row['amount'],
-                        high_price=row['high'],
-                        low_price=row['low'],
-                        asset=asset
-                    )
-                    created_cnt += created
+            job = partial(
+                fetch_tushare_history, fetcher, methods[asset.category],
+                asset.zs_code, cur_start_date, end_date
+            )
         elif asset.category == 'fund':
-            fund_data = api.get_fund_data(asset.code)
-            if fund_data is None:
-                LOGGER.warning('no data for fund: %s', asset.zs_code)
-                continue
-            history = defaultdict(dict)
-            for nav in fund_data['Data_netWorthTrend']:
-                date = str(datetime.fromtimestamp(nav['x'] / 1000).date())
-                history[date]['nav'] = nav['y']
-                if nav.get('unitMoney'):
-                    bonus_text = nav['unitMoney']
-                    action, value = 'unknown', None
-                    if bonus_text.startswith('分红'):
-                        action = 'bonus'
-                        value = float(re.findall(r'派现金(\d\.\d+)元', bonus_text)[0])
-                    elif bonus_text.startswith('拆分'):
-                        action = 'spin_off'
-                        value = float(re.findall(r'折算(\d\.\d+)份', bonus_text)[0])
-                    else:
-                        LOGGER.wanring("unknown bonus text: %s", bonus_text)
-
-                    if action != 'unknown':
-                        history[date]['bonus_action'] = action
-                        history[date]['bonus_value'] = value
-
-            for auv in fund_data['Data_ACWorthTrend']:
-                date = str(datetime.fromtimestamp(auv[0] / 1000).date())
-                history[date]['auv'] = auv[1]
-
-            for date, info in history.items():
-                if 'nav' not in info:
-                    LOGGER.warning("invalid history data: %s(%s)", info, date)
-
-                _, created = AssetMarketHistory.get_or_create(
-                    date=datetime.strptime(date, '%Y-%m-%d').date(),
-                    nav=info['nav'],
-                    auv=info.get('auv'),
-                    bonus_action=info.get('bonus_action'),
-                    bonus_value=info.get('bonus_value'),
-                    asset=asset
-                )
-                created_cnt += created
+            job = partial(fetch_fund_history, fetcher, api, asset.code)
+        else:
+            continue
+
+        jobs.append((asset, job))
+
+    # 请求在线程池中并发执行，数据库只在当前线程中写入
+    for asset, result, error in fetcher.run(jobs):
+        if error is not None:
+            LOGGER.warning(
+                'failed to fetch history of %s(%s): %s', asset.name, asset.zs_code, error
+            )
+            continue
+
+        if result is None:
+            LOGGER.warning('no data for fund: %s', asset.zs_code)
+            continue
+
+        names, rows = result
+        created_cnt = AssetMarketHistory.upsert_many(asset, names, rows)
+        PRICE_STORE.sync(asset.zs_code)
+        PRICE_BOOK.invalidate(asset.zs_code)
+        LOGGER.info('saved %d history records for %s(%s)', created_cnt, asset.name, asset.zs_code)
+
+    update_trading_calendar()
+
+
+def update_trading_calendar(start_date=None, end_date=None):
+    TRADING_CALENDAR.update(start_date, end_date)
+
+
+@main.command("update-calendar")
+@click.option('--start-date', help="默认从日历中需要更新的第一天开始，日历为空时为最早的行情日期")
+@click.option('--end-date', help="默认为今年年底")
+def update_calendar(start_date, end_date):
+    """根据节假日数据和行情数据更新交易日历"""
+    if start_date:
+        start_date = datetime.strptime(start_date, '%Y%m%d').date()
+    if end_date:
+        end_date = datetime.strptime(end_date, '%Y%m%d').date()
 
-        LOGGER.info('created %d history records for %s(%s)', created_cnt, asset.name, asset.zs_code)
+    update_trading_calendar(start_date, end_date)
 
 
 @main.command()
 @click.option("-i", "--infile", required=True)
-def import_deals(infile):
+@click.option("-r", "--report", help="将被拒绝或有警告的记录以 JSON Lines 格式写入该文件")
+def import_deals(infile, report):
     """从文件中批量导入交易"""
     with open(infile) as fin:
         reader = csv.reader(fin, delimiter='\t')
-        cnt, total = 0, 0
-        for row in reader:
-            if len(row) != 10:
-                LOGGER.warning('column number is not 10: %s', row)
-                continue
-
-            asset = Asset.get_or_none(Asset.zs_code == row[3])
-            if asset is None:
-                LOGGER.warning('no asset found for code: %s', row[3])
-                continue
+        created_cnt, duplicated_cnt, issues = bulk_import_deals(reader)
 
-            if asset.zs_code == 'CASH' and row[6] != row[8]:
-                LOGGER.error('cash record is not balanced: %s', row)
-                return
-
-            if row[5] == 'buy':
-                try:
-                    diff = abs(float(row[6]) * float(row[7]) + float(row[9]) - float(row[8]))
-                    assert diff < 0.001
-                except AssertionError:
-                    LOGGER.warning("record is not balanced: %s", row)
-                    print(row)
-
-            elif row[5] == 'sell':
-                try:
-                    diff = abs(float(row[6]) * float(row[7]) - float(row[9]) - float(row[8]))
-                    assert diff < 0.001
-                except AssertionError:
-                    LOGGER.warning("record is not balanced: %s", row)
-
-            _, created = Deal.get_or_create(
-                account=row[0],
-                sub_account=row[1],
-                time=datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S'),
-                asset=asset,
-                action=row[5],
-                amount=row[6],
-                price=row[7],
-                money=row[8],
-                fee=row[9]
-            )
-            total += 1
-            if created:
-                cnt += 1
+    if duplicated_cnt:
+        LOGGER.warning("%d records are already in database", duplicated_cnt)
 
-        if cnt != total:
-            LOGGER.warning("%d records are already in database", total - cnt)
+    if report:
+        with open(report, 'w') as fout:
+            for issue in issues:
+                print(json.dumps(issue, ensure_ascii=False), file=fout)
+    else:
+        for issue in issues:
+            LOGGER.warning("%s at line %d: %s", issue['reason'], issue['line'], issue['row'])
 
-        LOGGER.info("created %d records in database", cnt)
+    rejected_cnt = sum(1 for issue in issues if not issue['imported'])
+    LOGGER.info("created %d records in database, rejected %d records", created_cnt, rejected_cnt)
 
 
 @main.command()
@@ -694,7 +678,8 @@ def validate_deals():
 
 @main.command()
 @click.option('--accounts')
-def update_accounts(accounts):
+@click.option('--full', is_flag=True, help="忽略变更记录，从头重新计算")
+def update_accounts(accounts, full):
     """更新账户持仓和收益数据"""
     if not accounts:
         accounts = set([
@@ -704,37 +689,38 @@ def update_accounts(accounts):
     else:
         accounts = set(accounts.split(','))
 
+    dirty_dates = {} if full else AccountWatermark.get_dates(accounts)
     for account in accounts:
-        update_account_assets_history(account)
+        dirty_date = dirty_dates.get(account)
+        if full:
+            update_account_assets_history(account)
+            update_account_history(account)
+            continue
 
-    for account in accounts:
-        created_cnt, update_cnt = 0, 0
-        for item in compute_account_history(account):
-            record = AccountHistory.get_or_none(account=account, date=item[0])
-            if not record:
-                AccountHistory.create(
-                    account=account,
-                    date=item[0],
-                    amount=item[1],
-                    money=item[2],
-                    nav=item[3],
-                    cash=item[4],
-                    position=item[5],
-                )
-                created_cnt += 1
-            elif record.amount != item[1] or record.money != item[2]:
-                record.amount = item[1]
-                record.money = item[2]
-                record.nav = item[3]
-                record.cash = item[4]
-                record.position = item[5]
-                record.save()
-                update_cnt += 1
+        if dirty_date:
+            LOGGER.info('account %s has changed since %s', account, dirty_date)
+            update_account_assets_history(account, start_date=dirty_date)
 
-        LOGGER.info(
-            'created %d new history and update %d record for account %s',
-            created_cnt, update_cnt, account
-        )
+        # 没有变动时也需要重新计算最近一天的数据以及之后新增的交易日
+        last_date = AccountHistory.select(fn.MAX(AccountHistory.date)).\
+            where(AccountHistory.account == account).\
+            scalar()
+        start_date = last_date
+        if last_date is not None and dirty_date is not None:
+            start_date = min(dirty_date, last_date)
+
+        # 升级后还没有生成过资产市值数据的账户需要从头计算一次
+        if not AccountAssetValueHistory.select().\
+                where(AccountAssetValueHistory.account == account).\
+                exists():
+            start_date = None
+
+        update_account_history(account, start_date=start_date)
+
+        AccountWatermark.clear(account, dirty_date)
+
+    if full:
+        AccountWatermark.delete().where(AccountWatermark.account.in_(list(accounts))).execute()
 
 
 @main.command("price2bean")
@@ -898,6 +884,8 @@ def set_prices(zs_code, start_date, end_date, price):
         )
         created_cnt += 1
 
+    PRICE_STORE.sync(asset.zs_code)
+    PRICE_BOOK.invalidate(asset.zs_code)
     LOGGER.info('created %d history records for %s(%s)', created_cnt, asset.name, asset.zs_code)
 
 
@@ -1,6 +1,22 @@
 import dash
 import dash_bootstrap_components as dbc
 
+from keysersoze.models import DATABASE, configure_database
+
+
+# Web 服务只读取数据，和写入数据的命令行任务可以同时运行
+configure_database('reader')
 
 external_stylesheets = [dbc.themes.BOOTSTRAP]
 APP = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+
+
+@APP.server.before_request
+def open_database():
+    DATABASE.connect(reuse_if_open=True)
+
+
+@APP.server.teardown_request
+def close_database(exc):
+    if not DATABASE.is_closed():
+        DATABASE.close()
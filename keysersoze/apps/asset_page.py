@@ -1,20 +1,20 @@
 import re
-from operator import itemgetter
 from datetime import datetime, timedelta, date
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
+import numpy as np
 import pandas as pd
-from chinese_calendar import get_holidays
 import plotly.graph_objects as go
 
 from keysersoze.models import (
     Deal,
     Asset,
-    AssetMarketHistory,
+    PRICE_STORE,
 )
+from keysersoze.trading_calendar import TRADING_CALENDAR
 from keysersoze.apps.app import APP
 from keysersoze.apps.utils import make_card_component
 
@@ -158,29 +158,27 @@ def update_asset_graph(asset_code, date_range, customized_date_range):
         df.date = pd.to_datetime(df.date)
 
     fig = go.Figure()
-    data = []
     min_date = df.date.min() if start_date is None else start_date
-    prices = asset.history.where(AssetMarketHistory.date >= min_date)
+    if pd.isna(min_date):
+        min_date = None
     if end_date:
-        prices = prices.where(AssetMarketHistory.date < end_date)
+        end_date = end_date - timedelta(days=1)
 
-    for item in prices.order_by(AssetMarketHistory.date.desc()):
-        if item.close_price is not None:
-            data.append({
-                'date': item.date,
-                'open': item.open_price,
-                'close': item.close_price,
-                'high': item.high_price,
-                'low': item.low_price,
-            })
-        else:
-            data.append({
-                'date': item.date,
-                'price': item.nav,
-            })
+    dates, prices = PRICE_STORE.get_history(
+        asset.zs_code, min_date, end_date,
+        columns=['open_price', 'close_price', 'high_price', 'low_price', 'nav'],
+    )
+    if np.isnan(prices['close_price']).all():
+        price_df = pd.DataFrame({'date': dates, 'price': prices['nav']})
+    else:
+        price_df = pd.DataFrame({
+            'date': dates,
+            'open': prices['open_price'],
+            'close': prices['close_price'],
+            'high': prices['high_price'],
+            'low': prices['low_price'],
+        })
 
-    data.sort(key=itemgetter('date'))
-    price_df = pd.DataFrame(data)
     price_df.date = pd.to_datetime(price_df.date)
     if len(price_df.columns) == 2:
         fig.add_trace(
@@ -263,12 +261,7 @@ def update_asset_graph(asset_code, date_range, customized_date_range):
     )
     fig.update_xaxes(
         tickformat="%m/%d\n%Y",
-        rangebreaks=[
-            {'bounds': ["sat", "mon"]},
-            {
-                'values': get_holidays(price_df.date.min(), price_df.date.max(), False)
-            }
-        ]
+        rangebreaks=TRADING_CALENDAR.rangebreaks(price_df.date.min(), price_df.date.max())
     )
     return fig
 
@@ -12,19 +12,20 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import pandas as pd
-from chinese_calendar import get_holidays
 import plotly.graph_objects as go
 import numpy as np
 
 from keysersoze.models import (
     Deal,
     Asset,
-    AssetMarketHistory,
+    PRICE_BOOK,
+    PRICE_STORE,
 )
 from keysersoze.utils import (
     get_accounts_history,
     get_accounts_summary,
 )
+from keysersoze.trading_calendar import TRADING_CALENDAR
 from keysersoze.apps.app import APP
 from keysersoze.apps.utils import make_card_component
 
@@ -318,35 +319,22 @@ def update_after_check(accounts, index_codes):
     accounts = accounts or all_accounts
     summary_data, assets_data = get_accounts_summary(accounts)
 
-    history = get_accounts_history(accounts).to_dict('records')
-    history.sort(key=itemgetter('account', 'date'))
+    history = get_accounts_history(accounts)
 
     index_history = []
     for index_code in index_codes:
         index = Asset.get(zs_code=index_code)
-        for record in index.history:
+        dates, prices = PRICE_STORE.get_history(index_code)
+        for record_date, price in zip(dates.tolist(), prices['close_price'].tolist()):
             index_history.append({
                 'account': index.name,
-                'date': record.date,
-                'price': record.close_price
+                'date': record_date,
+                'price': None if np.isnan(price) else price,
             })
 
     index_history.sort(key=itemgetter('account', 'date'))
 
-    deals = []
-    for record in Deal.get_deals(accounts):
-        deals.append({
-            'account': record.account,
-            'time': record.time,
-            'code': record.asset.zs_code,
-            'name': record.asset.name,
-            'action': record.action,
-            'amount': record.amount,
-            'price': record.price,
-            'money': record.money,
-            'fee': record.fee,
-        })
-
+    deals = [record._asdict() for record in Deal.get_deals(accounts, namedtuples=True)]
     deals.sort(key=itemgetter('time'), reverse=True)
 
     valid_deals_count = 0
@@ -625,25 +613,8 @@ def make_asset_card(asset_info, show_money=True):
         )
     )
 
-    asset = Asset.get(zs_code=asset_info['code'])
-    prices = []
-    for item in asset.history.order_by(AssetMarketHistory.date.desc()).limit(10):
-        if item.close_price is not None:
-            prices.append({
-                'date': item.date,
-                'price': item.close_price,
-            })
-        else:
-            prices.append({
-                'date': item.date,
-                'price': item.nav,
-            })
-
-        if len(prices) >= 10:
-            break
-
-    prices.sort(key=itemgetter('date'))
-    df = pd.DataFrame(prices)
+    dates, prices = PRICE_BOOK.get_recent(asset_info['code'], 10)
+    df = pd.DataFrame({'date': dates, 'price': prices})
     df['date'] = pd.to_datetime(df['date'])
     fig = go.Figure()
     fig.add_trace(
@@ -663,12 +634,7 @@ def make_asset_card(asset_info, show_money=True):
         yaxis={'showticklabels': False, 'showgrid': False, 'fixedrange': True},
     )
     fig.update_xaxes(
-        rangebreaks=[
-            {'bounds': ["sat", "mon"]},
-            {
-                'values': get_holidays(df.date.min(), df.date.max(), False)
-            }
-        ]
+        rangebreaks=TRADING_CALENDAR.rangebreaks(df.date.min(), df.date.max())
     )
     body_content.append(
         make_card_component(
@@ -1139,9 +1105,9 @@ def update_return_range(date_range, customized_date_range):
     ]
 )
 def draw_asset_history(accounts_history, show_money, start_date, end_date):
-    accounts_history.sort(key=itemgetter('date'))
-    df = pd.DataFrame(accounts_history)
+    df = pd.DataFrame(accounts_history).sort_values('date', kind='mergesort')
     df = df[df['account'] == '总计']
+    start_amount = df.iloc[0]['amount']
     df.date = pd.to_datetime(df.date)
     if start_date is not None:
         df = df[df['date'] >= pd.to_datetime(start_date)]
@@ -1149,8 +1115,8 @@ def draw_asset_history(accounts_history, show_money, start_date, end_date):
         df = df[df['date'] < pd.to_datetime(end_date)]
 
     if not show_money:
-        df.loc[:, "amount"] = df.amount / accounts_history[0]['amount']
-        df.loc[:, "money"] = df.money / accounts_history[0]['amount']
+        df.loc[:, "amount"] = df.amount / start_amount
+        df.loc[:, "money"] = df.money / start_amount
 
     df["color"] = np.where(df.money > df.amount, 'red', 'green')
 
@@ -1323,11 +1289,6 @@ def draw_day_return_chart(accounts_history, start_date, end_date, show_money):
     )
     fig.update_xaxes(
         tickformat="%m/%d\n%Y",
-        rangebreaks=[
-            {'bounds': ["sat", "mon"]},
-            {
-                'values': get_holidays(df.date.min(), df.date.max(), False)
-            }
-        ]
+        rangebreaks=TRADING_CALENDAR.rangebreaks(df.date.min(), df.date.max())
     )
     return fig
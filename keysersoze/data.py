@@ -1,13 +1,21 @@
+import os
 import re
+import json
 import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from typing import NamedTuple
 from operator import itemgetter
 
 from requests import Session
-import execjs
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .http_cache import HttpCache
 from .models import (
+    DB_DIR,
     Deal,
     AccountHistory,
     AccountAssetsHistory,
@@ -15,6 +23,105 @@ from .models import (
 
 
 LOGGER = logging.getLogger(__name__)
+HTTP_CACHE_DIR = os.path.join(DB_DIR, 'http_cache')
+
+
+JS_VAR_PATTERN = re.compile(r'var ([a-zA-Z_][a-zA-Z_\d]*) ?=')
+JS_VALUE_DECODER = json.JSONDecoder(strict=False)
+JS_VALUE_END = re.compile(r'[ \t]*(;|\r?\n|$)')
+# 数组/对象字面量的组成部分：双引号字符串、单引号字符串、括号和其他字符
+JS_LITERAL_TOKEN = re.compile(
+    r'''"(?:[^"\\]|\\.)*"|'((?:[^'\\]|\\.)*)'|[\[{]|[\]}]|[^'"\[\]{}]+''',
+    re.S
+)
+JS_STRING_ESCAPE = re.compile(r'\\(.)|"', re.S)
+
+
+def _to_json_string(match):
+    """将单引号字符串中的双引号和转义字符转换为 JSON 字符串中的写法"""
+    if match.group() == '"' or match.group(1) == '"':
+        return '\\"'
+    if match.group(1) == "'":
+        return "'"
+
+    return match.group()
+
+
+def decode_js_literal(content, pos):
+    """从 `pos` 处解析一个 JSON 字面量，允许其中的字符串使用单引号，返回 (值, 结束位置)
+
+    无法解析时抛出 ValueError。
+    """
+    try:
+        return JS_VALUE_DECODER.raw_decode(content, pos)
+    except ValueError:
+        if pos >= len(content) or content[pos] not in "[{'":
+            raise
+
+    chunks, depth = [], 0
+    while True:
+        match = JS_LITERAL_TOKEN.match(content, pos)
+        if not match:
+            raise ValueError(f'unterminated js literal at {pos}')
+
+        token, pos = match.group(), match.end()
+        if match.group(1) is not None:
+            token = '"' + JS_STRING_ESCAPE.sub(_to_json_string, match.group(1)) + '"'
+        elif token in '[{':
+            depth += 1
+        elif token in ']}':
+            depth -= 1
+
+        chunks.append(token)
+        if depth == 0:
+            break
+
+    return JS_VALUE_DECODER.decode(''.join(chunks)), pos
+
+
+def parse_js_vars(content, names=None):
+    """提取 JavaScript 代码中 `var x = ...;` 形式定义的变量
+
+    变量值是字面量（字符串可以用单引号）时直接解析，其他变量（表达式等）再交给 execjs
+    执行整段代码后求值；指定 `names` 时只对其中的变量这样处理，其余无法直接解析的变量忽略。
+    """
+    data, unparsed = {}, []
+    pos = 0
+    while True:
+        match = JS_VAR_PATTERN.search(content, pos)
+        if not match:
+            break
+
+        var, pos = match.group(1), match.end()
+        while pos < len(content) and content[pos].isspace():
+            pos += 1
+
+        try:
+            value, end = decode_js_literal(content, pos)
+        except ValueError:
+            unparsed.append(var)
+            continue
+
+        # 字面量后还有其他内容时说明是表达式，如 `var x = 1 + 2;`
+        if not JS_VALUE_END.match(content, end):
+            unparsed.append(var)
+            continue
+
+        data[var] = value
+        pos = end
+
+    if names is not None:
+        unparsed = [var for var in unparsed if var in names]
+
+    if unparsed:
+        LOGGER.info('evaluating %d js variables with execjs: %s', len(unparsed), unparsed)
+        import execjs
+
+        js_data = execjs.compile(content)
+        for var in unparsed:
+            data[var] = js_data.eval(var)
+
+    return data
 
 
 class QiemanExporter:
@@ -22,15 +129,28 @@ class QiemanExporter:
     # source: https://gist.github.com/iwinux/30012ba5e21fba4580b2d2b74b934493
     BASE_URL = 'https://qieman.com/pmdj/v2'
 
-    def __init__(self, aid, request_id, sign, token, wallet_id=None):
+    def __init__(self, aid, request_id, sign, token, wallet_id=None, max_workers=8, retries=3):
         self.headers = {
             'Authorization': f'Bearer {token}',
             'x-aid': aid,
             'x-request-id': request_id,
             'x-sign': sign,
         }
+        # 连接池大小与并发数一致，各线程复用连接；连接失败和 429/5xx 响应按指数退避重试
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+            ),
+        )
         self.http = Session()
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
         self.wallet_id = wallet_id
+        self.max_workers = max_workers
 
     def list_profits(self, asset_id):
         """获取指定资产的日收益历史"""
@@ -45,15 +165,38 @@ class QiemanExporter:
 
         return resp
 
-    def list_orders(self, asset_id):
-        for order in self._list_orders(asset_id):
-            if order.get('hasDetail'):
-                order = self._http_get(f'/orders/{order["orderId"]}')
-                yield order
-            else:
-                yield order
+    def list_orders(self, asset_id, exported=(), since=None):
+        """按原有顺序产生订单记录，有详情的订单替换为详情
+
+        订单详情在线程池中并发获取，最多提前获取 `max_workers * 4` 条，
+        前面的订单还没有返回时后面的订单会先等待。
+        `exported` 中的订单（orderId）会被跳过；指定 `since`（acceptTime）时，
+        翻到整页订单都早于 `since` 的那一页后不再继续翻页。
+        """
+        def result(item):
+            return item.result() if isinstance(item, Future) else item
+
+        def result_ready(item):
+            return not isinstance(item, Future) or item.done()
+
+        window = self.max_workers * 4
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for order in self._list_orders(asset_id, since):
+                if order['orderId'] in exported:
+                    continue
+
+                if order.get('hasDetail'):
+                    order = executor.submit(self._http_get, f'/orders/{order["orderId"]}')
 
-    def _list_orders(self, asset_id):
+                pending.append(order)
+                while pending and (len(pending) > window or result_ready(pending[0])):
+                    yield result(pending.popleft())
+
+            while pending:
+                yield result(pending.popleft())
+
+    def _list_orders(self, asset_id, since=None):
         params = {'capitalAccountId': asset_id, 'size': 100, 'page': 0}
 
         while True:
@@ -63,6 +206,12 @@ class QiemanExporter:
             if resp['last']:
                 break
 
+            # 订单按时间倒序返回，整页都早于 since 时后面的订单也都早于 since
+            if since is not None and all(
+                    order.get('acceptTime', since) < since for order in resp['content']
+            ):
+                break
+
             params['page'] += 1
 
     def _http_get(self, path, params=None):
@@ -82,18 +231,27 @@ class FundBasis(NamedTuple):
 class EastMoneyFundExporter:
 
     FUND_LIST_URL = 'http://fund.eastmoney.com/js/fundcode_search.js'
-    JS_VAR_PATTERN = re.compile(r'var ([a-zA-Z_][a-zA-Z_\d]*) ?=')
     FUND_DATA_URL_TMP = 'http://fund.eastmoney.com/pingzhongdata/{code}.js'
+    # 基金数据中用到的变量，其他变量不是字面量时不需要求值
+    FUND_DATA_VARS = ('Data_netWorthTrend', 'Data_ACWorthTrend')
     BOND_URL_TMP = (
         'http://datacenter.eastmoney.com/api/data/get?'
         'type=RPTA_WEB_KZZ_LS&sty=ALL&filter=(ZCODE={code})'
     )
 
-    def __init__(self):
+    def __init__(self, cache=None):
         self.http = Session()
+        if cache is None:
+            cache = HttpCache(
+                HTTP_CACHE_DIR,
+                ttl=int(os.environ.get('KEYSERSOZE_HTTP_CACHE_TTL', 4 * 3600)),
+                max_size=int(os.environ.get('KEYSERSOZE_HTTP_CACHE_MB', 256)) * 1024 * 1024,
+                session=self.http,
+            )
+        self.cache = cache
 
     def list_funds(self):
-        resp = self.http.get(self.FUND_LIST_URL)
+        resp, data = self.cache.get_parsed(self.FUND_LIST_URL, parse_js_vars)
         if resp.status_code != 200:
             LOGGER.warning(
                 "failed to fetch fund list(%d: %s)",
@@ -101,16 +259,17 @@ class EastMoneyFundExporter:
             )
             return []
 
-        js_data = execjs.compile(resp.text)
         funds = []
-        for code, _, name, category, _ in js_data.eval('r'):
+        for code, _, name, category, _ in data['r']:
             funds.append(FundBasis(code=code, name=name, category=category))
 
         return funds
 
     def get_fund_data(self, fund_code):
         url = self.FUND_DATA_URL_TMP.format(code=fund_code)
-        resp = self.http.get(url)
+        resp, data = self.cache.get_parsed(
+            url, partial(parse_js_vars, names=self.FUND_DATA_VARS)
+        )
         if resp.status_code != 200:
             LOGGER.warning(
                 "failed to get data of fund: %s(%d: %s)",
@@ -118,13 +277,6 @@ class EastMoneyFundExporter:
             )
             return None
 
-        content = resp.text
-        js_data = execjs.compile(content)
-        var_names = self.JS_VAR_PATTERN.findall(content)
-        data = {}
-        for var in var_names:
-            data[var] = js_data.eval(var)
-
         return data
 
     def get_bond_history(self, bond_code):
@@ -0,0 +1,121 @@
+"""并发获取外部数据
+
+请求在线程池中执行，每个数据源使用单独的令牌桶限速，失败时按指数退避重试。
+获取到的结果按完成顺序交还给调用方，由调用方所在的线程统一写入数据库，
+工作线程中不应访问数据库。
+"""
+import re
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests import exceptions
+
+
+LOGGER = logging.getLogger(__name__)
+# 只有网络层面的临时错误才重试，程序错误和 4xx 等重试也不会成功的错误直接抛出
+TRANSIENT_ERRORS = (
+    exceptions.ConnectionError,
+    exceptions.Timeout,
+    exceptions.ChunkedEncodingError,
+    ConnectionError,
+    TimeoutError,
+)
+# tushare 超过每分钟的访问次数时只抛出 Exception，如「抱歉，您每分钟最多访问该接口500次，……」，
+# 按提示信息识别；每天的访问次数用完时当天重试也不会成功，不在此列
+RATE_LIMIT_MESSAGE = re.compile(r'每分钟最多访问')
+
+
+def is_transient_error(error):
+    """判断请求异常是否为可以重试的临时错误：网络错误、超时、429/5xx 响应以及 tushare 的限频错误"""
+    if isinstance(error, exceptions.HTTPError):
+        return error.response is not None and (
+            error.response.status_code == 429 or error.response.status_code >= 500
+        )
+
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+
+    return RATE_LIMIT_MESSAGE.search(str(error)) is not None
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 `rate` 个令牌，最多积累 `capacity` 个，没有令牌时阻塞等待"""
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _wait_time(self):
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait_time = self._wait_time()
+            if wait_time <= 0:
+                return
+
+            self.sleep(wait_time)
+
+
+class Fetcher:
+    """限速、重试并发执行数据获取任务
+
+    `limits` 为 {数据源: (每分钟请求数, 突发请求数)}。任务函数在线程池中执行，
+    其中的每次请求都应通过 `call` 发起，以便按数据源限速和重试。
+    `is_transient` 判断异常是否可以重试，默认为 `is_transient_error`。
+    """
+
+    def __init__(self, limits, max_workers=8, retries=3, backoff=1.0, sleep=time.sleep,
+                 is_transient=is_transient_error):
+        self.buckets = {
+            provider: TokenBucket(per_minute / 60.0, capacity=burst, sleep=sleep)
+            for provider, (per_minute, burst) in limits.items()
+        }
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.is_transient = is_transient
+
+    def call(self, provider, func, *args, **kwargs):
+        """在数据源 `provider` 的限速下调用 `func`，遇到临时错误时退避后重试"""
+        bucket = self.buckets[provider]
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                if attempt == self.retries or not self.is_transient(error):
+                    raise
+
+                delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+                LOGGER.warning(
+                    'request to %s failed(%s), retry in %.1f seconds', provider, error, delay
+                )
+                self.sleep(delay)
+
+    def run(self, jobs):
+        """执行 (key, func) 形式的任务，按完成顺序产生 (key, 结果, 异常)"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(func): key for key, func in jobs}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as error:
+                    yield futures[future], None, error
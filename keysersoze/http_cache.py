@@ -0,0 +1,189 @@
+"""保存在本地目录中的 HTTP 响应缓存"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import NamedTuple
+
+from requests import Session
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CachedResponse(NamedTuple):
+
+    status_code: int
+    reason: str
+    content: bytes
+    encoding: str
+    from_cache: bool            # 正文是否来自本地缓存（未过期或服务端返回 304）
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+class HttpCache:
+    """HTTP GET 响应的磁盘缓存
+
+    每个 URL 保存一个正文文件和一个记录 ETag/Last-Modified/获取时间的元数据文件。
+    缓存在 `ttl` 秒内直接使用，过期后发起带 If-None-Match/If-Modified-Since 的条件请求，
+    服务端返回 304 时只刷新获取时间。总大小超过 `max_size` 字节时按最近使用时间淘汰。
+    `get_parsed` 还会保存正文解析后的结果，正文没有变化时不再重复解析。
+    """
+
+    def __init__(self, directory, ttl=4 * 3600, max_size=256 * 1024 * 1024, session=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.http = session or Session()
+        self._total_size = None
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, f'{key}.{suffix}')
+
+    @staticmethod
+    def _key(url, params):
+        if params:
+            url = url + '?' + '&'.join(f'{key}={params[key]}' for key in sorted(params))
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key, 'meta')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, key, suffix, content):
+        # 先写临时文件再替换，并发读取时不会读到写了一半的文件
+        path = self._path(key, suffix)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        mode = 'wb' if isinstance(content, bytes) else 'w'
+        with open(tmp_path, mode) as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _read_body(self, key):
+        try:
+            with open(self._path(key, 'body'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, url, params=None, **kwargs):
+        key = self._key(url, params)
+        meta = self._read_meta(key)
+        body = self._read_body(key) if meta else None
+        if meta and body is not None:
+            os.utime(self._path(key, 'meta'))
+            if time.time() - meta['fetched_at'] < self.ttl:
+                return CachedResponse(200, 'OK', body, meta['encoding'], True)
+
+            headers = dict(kwargs.pop('headers', None) or {})
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            kwargs['headers'] = headers
+
+        resp = self.http.get(url, params=params, **kwargs)
+        if resp.status_code == 304 and meta and body is not None:
+            meta['fetched_at'] = time.time()
+            self._write(key, 'meta', json.dumps(meta))
+            return CachedResponse(200, 'OK', body, meta['encoding'], True)
+
+        if resp.status_code != 200:
+            return CachedResponse(resp.status_code, resp.reason, resp.content, resp.encoding, False)
+
+        encoding = resp.encoding or resp.apparent_encoding
+        self._write(key, 'body', resp.content)
+        self._write(key, 'meta', json.dumps({
+            'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'encoding': encoding,
+            'fetched_at': time.time(),
+        }))
+        self._account(len(resp.content) - (len(body) if body is not None else 0))
+        return CachedResponse(200, resp.reason, resp.content, encoding, False)
+
+    def get_parsed(self, url, parse, params=None, **kwargs):
+        """返回 (响应, parse(响应正文))，响应不是 200 时解析结果为 None
+
+        解析结果需要能序列化为 JSON，正文和上次解析时相同时直接读取保存的结果。
+        """
+        resp = self.get(url, params=params, **kwargs)
+        if resp.status_code != 200:
+            return resp, None
+
+        key = self._key(url, params)
+        version = hashlib.sha1(resp.content).hexdigest()
+        try:
+            with open(self._path(key, 'parsed')) as f:
+                parsed = json.load(f)
+            if parsed['version'] == version:
+                return resp, parsed['data']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        data = parse(resp.text)
+        path = self._path(key, 'parsed')
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        content = json.dumps({'version': version, 'data': data})
+        self._write(key, 'parsed', content)
+        self._account(os.path.getsize(path) - old_size)
+        return resp, data
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            key, _, suffix = name.partition('.')
+            if suffix != 'meta':
+                continue
+
+            size = 0
+            for cur_suffix in ('body', 'parsed'):
+                path = self._path(key, cur_suffix)
+                if os.path.exists(path):
+                    size += os.path.getsize(path)
+
+            entries.append((os.path.getmtime(self._path(key, 'meta')), key, size))
+
+        return entries
+
+    def _account(self, delta):
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = sum(size for _, _, size in self._scan())
+            else:
+                self._total_size += delta
+
+            if self._total_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """按最近使用时间从旧到新删除，直到总大小降到上限的 90% 以下"""
+        entries = sorted(self._scan())
+        total_size = sum(size for _, _, size in entries)
+        removed = 0
+        for _, key, size in entries:
+            if total_size <= self.max_size * 0.9:
+                break
+
+            for suffix in ('meta', 'body', 'parsed'):
+                path = self._path(key, suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+            total_size -= size
+            removed += 1
+
+        self._total_size = total_size
+        LOGGER.info('evicted %d entries from http cache, %d bytes left', removed, total_size)
@@ -0,0 +1,98 @@
+"""数据库结构迁移
+
+已完成的迁移数量记录在 SQLite 的 `user_version` 中，`migrate` 按顺序执行尚未执行的迁移，
+每个迁移都在单独的事务中完成。迁移本身会检查当前的表结构，对新建的数据库重复执行也是安全的。
+"""
+import logging
+
+from .models import (
+    DATABASE,
+    AssetMarketHistory,
+    AccountAssetValueHistory,
+    AccountWatermark,
+    AssetPriceVersion,
+    CalendarDay,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_version():
+    return DATABASE.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_version(version):
+    DATABASE.execute_sql(f'PRAGMA user_version = {int(version)}')
+
+
+def create_account_watermark():
+    """创建账户变动标记表及维护它的触发器"""
+    DATABASE.create_tables([AccountWatermark])
+    AccountWatermark.install_triggers()
+
+
+def rebuild_asset_market_history():
+    """将 AssetMarketHistory 的复合主键改为自增主键和 (asset, date) 唯一索引
+
+    同一资产同一日期有多条记录时（价格修正后产生的重复数据），保留最后写入的一条。
+    """
+    table = AssetMarketHistory._meta.table_name
+    columns = [column.name for column in DATABASE.get_columns(table)]
+    if 'id' in columns:
+        return
+
+    old_table = f'{table}_old'
+    DATABASE.execute_sql(f'ALTER TABLE "{table}" RENAME TO "{old_table}"')
+    for index in DATABASE.get_indexes(old_table):
+        if index.sql:
+            DATABASE.execute_sql(f'DROP INDEX "{index.name}"')
+
+    AssetMarketHistory.create_table()
+    columns = ', '.join(f'"{name}"' for name in columns)
+    cursor = DATABASE.execute_sql(
+        f'INSERT INTO "{table}" ({columns}) '
+        f'SELECT {columns} FROM "{old_table}" '
+        f'WHERE rowid IN (SELECT MAX(rowid) FROM "{old_table}" GROUP BY asset_id, date)'
+    )
+    LOGGER.info('copied %d records into the new %s table', cursor.rowcount, table)
+
+    # 旧表上的触发器会随旧表一起删除
+    DATABASE.execute_sql(f'DROP TABLE "{old_table}"')
+    AccountWatermark.install_triggers()
+
+
+def create_calendar_day():
+    """创建交易日历表"""
+    DATABASE.create_tables([CalendarDay])
+
+
+def create_account_asset_value_history():
+    """创建资产每日市值表，已有账户的数据在下一次 update-accounts 时全量生成"""
+    DATABASE.create_tables([AccountAssetValueHistory])
+
+
+def create_asset_price_version():
+    """创建资产行情变动计数表及维护它的触发器"""
+    DATABASE.create_tables([AssetPriceVersion])
+    AssetPriceVersion.install_triggers()
+
+
+MIGRATIONS = [
+    create_account_watermark,
+    rebuild_asset_market_history,
+    create_calendar_day,
+    create_account_asset_value_history,
+    create_asset_price_version,
+]
+
+
+def migrate():
+    version = get_version()
+    for idx, migration in enumerate(MIGRATIONS[version:], version + 1):
+        LOGGER.info('applying migration %d: %s', idx, migration.__name__)
+        with DATABASE.atomic():
+            migration()
+            set_version(idx)
+
+    return len(MIGRATIONS) - version
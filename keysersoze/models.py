@@ -1,19 +1,34 @@
 import os
+import time
 import logging
+import operator
+import threading
+from functools import reduce
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from operator import itemgetter
 
 from peewee import (
     SqliteDatabase,
+    BooleanField,
+    Case,
     Model,
     CharField,
     DateTimeField,
     FloatField,
+    IntegerField,
     CompositeKey,
     ForeignKeyField,
     DateField,
+    Expression,
+    EXCLUDED,
+    SQL,
+    Select,
+    Value,
+    fn,
 )
+import numpy as np
+import pandas as pd
 from scipy import optimize
 
 
@@ -25,17 +40,124 @@ DB_DIR = os.environ.get(
 if not os.path.exists(DB_DIR):
     os.makedirs(DB_DIR)
 
-DATABASE = SqliteDatabase(os.path.join(DB_DIR, 'db.sqlite3'))
+DB_PATH = os.path.join(DB_DIR, 'db.sqlite3')
+# 3.32 之前的 SQLite 默认每条语句最多绑定 999 个参数
+SQLITE_MAX_VARIABLES = 999
+DB_PRAGMAS = {
+    'journal_mode': 'wal',
+    'cache_size': -int(os.environ.get('KEYSERSOZE_DB_CACHE_KB', 64 * 1024)),
+    'mmap_size': int(os.environ.get('KEYSERSOZE_DB_MMAP_SIZE', 256 * 1024 * 1024)),
+}
+DB_PROFILES = {
+    # 命令行等会写入数据的进程
+    'writer': dict(DB_PRAGMAS, synchronous='normal'),
+    # Web 服务等只读的进程，WAL 模式下读取不会被写入阻塞
+    'reader': dict(DB_PRAGMAS, query_only=1),
+}
+DATABASE = SqliteDatabase(None)
 
 
-def xnpv(cashflows, rate):
+def configure_database(profile=None):
+    """按指定的配置打开数据库，未指定时使用环境变量 KEYSERSOZE_DB_PROFILE，默认为 writer
+
+    连接是按线程维护的，每个线程在第一次查询时打开自己的连接。
+    """
+    profile = profile or os.environ.get('KEYSERSOZE_DB_PROFILE', 'writer')
+    DATABASE.init(DB_PATH, pragmas=DB_PROFILES[profile])
+
+
+configure_database()
+
+
+def year_fractions(cashflows):
+    """将 (日期, 金额) 形式的现金流转换为「距第一笔现金流的年数」和「金额」两个数组"""
     chron_order = sorted(cashflows, key=itemgetter(0))
     t0 = chron_order[0][0]
-    return sum([cf / (1 + rate) ** ((t - t0).days / 365.0) for (t, cf) in chron_order])
+    years = np.array([(t - t0).days / 365.0 for t, _ in chron_order])
+    amounts = np.array([cf for _, cf in chron_order], dtype=float)
+    return years, amounts
+
+
+def xnpv(cashflows, rate):
+    years, amounts = year_fractions(cashflows)
+    return float(np.sum(amounts / (1 + rate) ** years))
+
+
+def _bracketed_xirr(years, amounts):
+    """在一组候选区间中找到 NPV 变号的区间，用 brentq 求解"""
+    def npv(rate):
+        return np.sum(amounts / (1 + rate) ** years)
+
+    candidates = [-0.999, -0.99, -0.9, -0.5, 0.0, 0.5, 1.0, 2.0, 5.0, 10.0, 100.0, 1000.0]
+    with np.errstate(all='ignore'):
+        values = [npv(rate) for rate in candidates]
+
+    for idx in range(len(candidates) - 1):
+        if np.isfinite(values[idx]) and np.isfinite(values[idx + 1]) and \
+           values[idx] * values[idx + 1] <= 0:
+            return optimize.brentq(npv, candidates[idx], candidates[idx + 1])
+
+    return None
+
+
+def xirr_many(series, guess=0.1, tol=1e-10, maxiter=50):
+    """批量计算多组现金流的年化收益率
+
+    各组现金流补齐为同样长度的矩阵，NPV 和它对收益率的导数用 NumPy 一起计算，
+    所有组同时进行牛顿迭代；不收敛或发散的组再用区间方法求解，仍然无解时结果为 None。
+    """
+    years = np.zeros((len(series), max(len(cashflows) for cashflows in series)))
+    amounts = np.zeros(years.shape)
+    for idx, cashflows in enumerate(series):
+        cur_years, cur_amounts = year_fractions(cashflows)
+        years[idx, :len(cur_years)] = cur_years
+        amounts[idx, :len(cur_amounts)] = cur_amounts
+
+    rates = np.full(len(series), guess, dtype=float)
+    converged = np.zeros(len(series), dtype=bool)
+    diverged = np.zeros(len(series), dtype=bool)
+    with np.errstate(all='ignore'):
+        for _ in range(maxiter):
+            active = ~converged & ~diverged
+            if not active.any():
+                break
+
+            base = 1 + rates[active, None]
+            discounted = amounts[active] * base ** -years[active]
+            npv = discounted.sum(axis=1)
+            derivative = (-years[active] * discounted / base).sum(axis=1)
+            step = npv / derivative
+            rates[active] -= step
+            converged[active] = np.abs(step) < tol
+            diverged[active] = ~np.isfinite(rates[active]) | (rates[active] <= -1)
+
+    results = []
+    for idx, rate in enumerate(rates.tolist()):
+        if converged[idx] and not diverged[idx]:
+            results.append(rate)
+        else:
+            results.append(_bracketed_xirr(years[idx], amounts[idx]))
+
+    return results
 
 
 def xirr(cashflows, guess=0.1):
-    return optimize.newton(lambda r: xnpv(cashflows, r), guess)
+    return xirr_many([cashflows], guess=guess)[0]
+
+
+def get_annualized_returns(cash_flows):
+    """批量计算多组 {日期: 金额} 现金流的年化收益率，时间跨度不足 30 天的为 None"""
+    results = [None] * len(cash_flows)
+    indices = [
+        idx for idx, cash_flow in enumerate(cash_flows)
+        if (max(cash_flow) - min(cash_flow)).days >= 30
+    ]
+    if indices:
+        rates = xirr_many([sorted(cash_flows[idx].items(), key=itemgetter(0)) for idx in indices])
+        for idx, rate in zip(indices, rates):
+            results[idx] = round(rate, 4) if rate is not None else None
+
+    return results
 
 
 class BaseModel(Model):
@@ -54,17 +176,7 @@ class Asset(BaseModel):
         if self.zs_code == 'CASH' or self.category == 'other':
             return 1.0, date
 
-        price_record = self.history.\
-            where(AssetMarketHistory.date <= date).\
-            order_by(AssetMarketHistory.date.desc()).\
-            first()
-        if price_record:
-            if self.zs_code.endswith('OF'):
-                return price_record.nav, price_record.date
-            else:
-                return price_record.close_price, price_record.date
-
-        return None, None
+        return PRICE_BOOK.get_price(self.zs_code, date)
 
     def get_buying_records(self, account=None, date=None):
         search = self.deals.where(Deal.action == 'buy')
@@ -112,36 +224,114 @@ class Deal(BaseModel):
         primary_key = CompositeKey('account', 'time', 'asset', 'amount')
 
     @classmethod
-    def get_deals(cls, accounts, date=None, actions=None):
-        deals = []
-        for account in accounts:
-            search = cls.select().where(cls.account == account)
-            if date:
-                time = datetime.combine(date, datetime.max.time())
-                search = search.where(cls.time < time)
+    def get_deals(cls, accounts, date=None, actions=None, namedtuples=False):
+        """一次查询多个账户截至 `date`（含）的交易记录，关联的 Asset 在同一查询中取出
 
-            for record in search:
-                if not actions or record.action in actions:
-                    deals.append(record)
+        `namedtuples` 为 True 时返回包含 account/time/code/name/action/amount/price/money/fee
+        字段的 namedtuple，不再构造模型实例。
+        """
+        if namedtuples:
+            search = cls.select(
+                cls.account, cls.time, Asset.zs_code.alias('code'), Asset.name,
+                cls.action, cls.amount, cls.price, cls.money, cls.fee,
+            )
+        else:
+            search = cls.select(cls, Asset)
 
-        return deals
+        search = search.join(Asset).where(cls.account.in_(list(accounts)))
+        if date:
+            time = datetime.combine(date, datetime.max.time())
+            search = search.where(cls.time < time)
+
+        if actions:
+            search = search.where(cls.action.in_(list(actions)))
+
+        search = search.order_by(cls.account, cls.time)
+        if namedtuples:
+            return list(search.namedtuples())
+
+        return list(search)
 
     @classmethod
     def get_cash_flow(cls, accounts, date=None):
-        cash_flow = defaultdict(float)
-        actions = set(['transfer_in', 'transfer_out'])
-        for record in cls.get_deals(accounts, date=date, actions=actions):
-            if record.action == 'transfer_in':
-                cash_flow[record.time.date()] -= record.money
+        return CashFlowLedger.load(accounts).get_cash_flow(date)
+
+    @classmethod
+    def get_total_invested(cls, account, date=None):
+        return CashFlowLedger.load([account]).get_invested(date)
+
+
+class CashFlowLedger:
+    """账户资金转入转出的现金流账本
+
+    转入转出记录按日期汇总后只加载一次，保存为有序的日期数组和累计投入数组，
+    「截至某日的总投入」通过二分查找得到。现金流以投资者视角记录，转入为负，转出为正。
+    """
+
+    ACTIONS = ('transfer_in', 'transfer_out')
+
+    def __init__(self, dates, flows):
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.flows = np.asarray(flows, dtype=float)
+        self.invested = -np.cumsum(self.flows)
+
+    @classmethod
+    def _from_flows(cls, date2flow):
+        dates = sorted(date2flow)
+        return cls(dates, [date2flow[date] for date in dates])
+
+    @classmethod
+    def load_many(cls, accounts):
+        """一次查询得到多个账户各自的账本"""
+        account2flows = {account: defaultdict(float) for account in accounts}
+        search = Deal.select(Deal.account, Deal.time, Deal.action, Deal.money).\
+            where(Deal.account.in_(list(accounts))).\
+            where(Deal.action.in_(cls.ACTIONS))
+        for account, deal_time, action, money in search.tuples():
+            if action == 'transfer_in':
+                account2flows[account][deal_time.date()] -= money
             else:
-                cash_flow[record.time.date()] += record.money
+                account2flows[account][deal_time.date()] += money
 
-        return cash_flow
+        return {account: cls._from_flows(flows) for account, flows in account2flows.items()}
 
     @classmethod
-    def get_total_invested(cls, account, date=None):
-        cash_flow = cls.get_cash_flow([account], date=date)
-        return 0 - sum(cash_flow.values())
+    def load(cls, accounts):
+        return cls.merge(cls.load_many(accounts).values())
+
+    @classmethod
+    def merge(cls, ledgers):
+        date2flow = defaultdict(float)
+        for ledger in ledgers:
+            for date, flow in zip(ledger.dates.tolist(), ledger.flows.tolist()):
+                date2flow[date] += flow
+
+        return cls._from_flows(date2flow)
+
+    def _index(self, date):
+        if date is None:
+            return len(self.dates)
+
+        return int(np.searchsorted(self.dates, np.datetime64(date, 'D'), side='right'))
+
+    def get_invested(self, date=None):
+        """截至 `date`（含）的总投入"""
+        idx = self._index(date)
+        return float(self.invested[idx - 1]) if idx > 0 else 0.0
+
+    def get_invested_series(self, dates):
+        """批量查询多个日期的总投入"""
+        idx = np.searchsorted(self.dates, np.asarray(dates, dtype='datetime64[D]'), side='right')
+        invested = np.zeros(len(idx))
+        invested[idx > 0] = self.invested[idx[idx > 0] - 1]
+        return invested
+
+    def get_cash_flow(self, date=None):
+        """截至 `date`（含）每日的现金流"""
+        idx = self._index(date)
+        cash_flow = defaultdict(float)
+        cash_flow.update(zip(self.dates[:idx].tolist(), self.flows[:idx].tolist()))
+        return cash_flow
 
 
 class AssetMarketHistory(BaseModel):
@@ -160,10 +350,301 @@ class AssetMarketHistory(BaseModel):
     auv = FloatField(null=True)         # 基金累计净值: Accumulated Unit Value
     bonus_action = CharField(index=True, null=True)
     bonus_value = FloatField(null=True)
-    asset = ForeignKeyField(Asset, backref='history')
+    # (asset, date) 上的唯一索引已经能满足按资产查询，不再单独为 asset 建索引
+    asset = ForeignKeyField(Asset, backref='history', index=False)
 
     class Meta:
-        primary_key = CompositeKey('date', 'asset', 'open_price', 'close_price', 'nav')
+        indexes = (
+            (('asset', 'date'), True),
+        )
+
+    @classmethod
+    def _on_conflict_update(cls, query, names):
+        """(asset, date) 冲突时更新有变化的字段，没有变化的记录不会被改写"""
+        columns = [cls._meta.fields[name] for name in names if name not in ('asset', 'date')]
+        changed = reduce(operator.or_, [
+            Expression(column, 'IS NOT', EXCLUDED[column.column_name]) for column in columns
+        ])
+        return query.on_conflict(
+            conflict_target=[cls.asset, cls.date],
+            preserve=columns,
+            where=changed,
+        )
+
+    @classmethod
+    def upsert(cls, **fields):
+        """按 (asset, date) 写入一条行情记录，已存在时更新有变化的字段
+
+        返回数据库中的记录是否被插入或修改。
+        """
+        query = cls._on_conflict_update(cls.insert(**fields), fields)
+        return cls._meta.database.execute(query).rowcount > 0
+
+    @classmethod
+    def upsert_many(cls, asset, names, rows, batch_size=None):
+        """批量写入一个资产的行情记录
+
+        `rows` 为按 `names` 中的字段顺序排列的元组，`names` 中需要包含 date，空值用 None 表示。
+        先用一次查询取出这些日期上已有的记录，跳过完全相同的行，其余的在一个事务中分批写入，
+        默认每批的参数个数不超过 SQLite 的默认上限。返回写入的记录数。
+        """
+        if not rows:
+            return 0
+
+        date_idx = names.index('date')
+        dates = [row[date_idx] for row in rows]
+        fields = [cls._meta.fields[name] for name in names]
+        search = cls.select(*fields).\
+            where(cls.asset == asset).\
+            where(cls.date.between(min(dates), max(dates)))
+        existed = set(search.tuples())
+        rows = [row for row in rows if tuple(row) not in existed]
+
+        fields = fields + [cls.asset]
+        batch_size = batch_size or SQLITE_MAX_VARIABLES // len(fields)
+        with cls._meta.database.atomic():
+            for idx in range(0, len(rows), batch_size):
+                batch = [tuple(row) + (asset,) for row in rows[idx:idx + batch_size]]
+                query = cls.insert_many(batch, fields=fields)
+                cls._on_conflict_update(query, names).execute()
+
+        return len(rows)
+
+
+class PriceBook:
+    """资产价格的内存索引
+
+    每个资产的历史价格只从数据库加载一次，保存为按日期排序的数组，之后
+    「某日及之前最近的价格」通过二分查找得到。缓存按 LRU 淘汰，超过 `ttl`
+    秒的条目在下次使用前会检查数据库中的记录数、最新日期和 AssetPriceVersion 中的变动计数，
+    有变化则重新加载；写入价格的一方应调用 `invalidate` 立即失效。
+    """
+
+    def __init__(self, capacity=512, ttl=600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._books = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def price_field(zs_code):
+        """场外基金使用单位净值，其他品种使用收盘价"""
+        if zs_code.endswith('OF'):
+            return AssetMarketHistory.nav
+
+        return AssetMarketHistory.close_price
+
+    def _signature(self, zs_code):
+        field = self.price_field(zs_code)
+        search = AssetMarketHistory.select(
+            fn.COUNT(AssetMarketHistory.date),
+            fn.MAX(AssetMarketHistory.date),
+        )
+        search = search.where(AssetMarketHistory.asset == zs_code).where(field.is_null(False))
+        signature = tuple(search.tuples().get())
+        # 未执行 migrate-db 的旧数据库中没有这张表，此时只能发现新增的价格
+        if AssetPriceVersion.table_exists():
+            signature += (AssetPriceVersion.get_version(zs_code),)
+
+        return signature
+
+    def _load(self, zs_code):
+        field = self.price_field(zs_code)
+        dates, columns = PRICE_STORE.get_history(zs_code, columns=[field.name])
+        prices = columns[field.name]
+        valid = ~np.isnan(prices)
+        return {
+            'dates': dates[valid],
+            'prices': prices[valid],
+            'signature': self._signature(zs_code),
+            'checked_at': time.time(),
+        }
+
+    def _get_book(self, zs_code):
+        with self._lock:
+            book = self._books.get(zs_code)
+            now = time.time()
+            if book is not None and now - book['checked_at'] > self.ttl:
+                if self._signature(zs_code) == book['signature']:
+                    book['checked_at'] = now
+                else:
+                    book = None
+
+            if book is None:
+                book = self._load(zs_code)
+                self._books[zs_code] = book
+
+            self._books.move_to_end(zs_code)
+            while len(self._books) > self.capacity:
+                self._books.popitem(last=False)
+
+            return book
+
+    def get_price(self, zs_code, date=None):
+        """返回指定日期及之前最近的价格及其日期，未指定日期时返回最新价格"""
+        book = self._get_book(zs_code)
+        if date is None:
+            idx = len(book['dates']) - 1
+        else:
+            idx = np.searchsorted(book['dates'], np.datetime64(date, 'D'), side='right') - 1
+
+        if idx < 0:
+            return None, None
+
+        return float(book['prices'][idx]), book['dates'][idx].item()
+
+    def get_prices(self, zs_code, dates):
+        """批量查询多个日期的价格，没有价格的日期为 nan"""
+        book = self._get_book(zs_code)
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        idx = np.searchsorted(book['dates'], dates, side='right') - 1
+        prices = np.full(len(dates), np.nan)
+        prices[idx >= 0] = book['prices'][idx[idx >= 0]]
+        return prices
+
+    def get_history(self, zs_code, start_date=None, end_date=None):
+        """返回 [start_date, end_date] 内的日期和价格数组"""
+        book = self._get_book(zs_code)
+        dates, prices = book['dates'], book['prices']
+        start, end = 0, len(dates)
+        if start_date is not None:
+            start = np.searchsorted(dates, np.datetime64(start_date, 'D'), side='left')
+        if end_date is not None:
+            end = np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right')
+
+        return dates[start:end], prices[start:end]
+
+    def get_recent(self, zs_code, count):
+        """最近 `count` 个有价格的日期和价格，只查询需要的记录，不加载整个历史"""
+        field = self.price_field(zs_code)
+        search = AssetMarketHistory.select(AssetMarketHistory.date, field).\
+            where(AssetMarketHistory.asset == zs_code).\
+            where(field.is_null(False)).\
+            order_by(AssetMarketHistory.date.desc()).\
+            limit(count)
+        rows = list(search.tuples())[::-1]
+        dates = np.array([row[0] for row in rows], dtype='datetime64[D]')
+        prices = np.array([row[1] for row in rows], dtype=float)
+        return dates, prices
+
+    def invalidate(self, zs_code=None):
+        with self._lock:
+            if zs_code is None:
+                self._books.clear()
+            else:
+                self._books.pop(zs_code, None)
+
+
+PRICE_BOOK = PriceBook()
+
+
+class PriceStore:
+    """AssetMarketHistory 的列式本地缓存
+
+    每个资产的全部行情保存为一个按日期排序的结构化 `.npy` 文件，读取时以只读方式内存映射，
+    按日期范围切片得到的日期和价格数组都是文件上的视图，不复制数据。
+    缓存目录存在时启用（可由 `sync-price-store` 创建，删除目录即停用），写入行情的一方
+    应调用 `sync` 保持同步；没有缓存文件的资产直接查询数据库，返回的数据格式相同。
+    """
+
+    COLUMNS = (
+        'open_price', 'close_price', 'pre_close', 'change', 'pct_change',
+        'vol', 'amount', 'high_price', 'low_price', 'nav', 'auv',
+    )
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @property
+    def enabled(self):
+        return os.path.isdir(self.directory)
+
+    def path(self, zs_code):
+        return os.path.join(self.directory, f'{zs_code}.npy')
+
+    def _query(self, zs_code, columns, start_date=None, end_date=None):
+        dtype = np.dtype([('date', 'datetime64[D]')] + [(name, 'f8') for name in columns])
+        fields = [AssetMarketHistory.date] + [getattr(AssetMarketHistory, name) for name in columns]
+        search = AssetMarketHistory.select(*fields).\
+            where(AssetMarketHistory.asset == zs_code)
+        # 日期范围可能是 datetime/pandas.Timestamp，按天比较
+        if start_date is not None:
+            start_date = np.datetime64(start_date, 'D').item()
+            search = search.where(AssetMarketHistory.date >= start_date)
+        if end_date is not None:
+            end_date = np.datetime64(end_date, 'D').item()
+            search = search.where(AssetMarketHistory.date <= end_date)
+
+        search = search.order_by(AssetMarketHistory.date)
+        rows = list(search.tuples())
+        data = np.empty(len(rows), dtype=dtype)
+        if rows:
+            # 空值转换为 nan
+            for name, values in zip(dtype.names, zip(*rows)):
+                data[name] = np.array(values, dtype=dtype[name])
+
+        return data
+
+    def sync(self, zs_code):
+        """用数据库中的数据重写资产的缓存文件，未启用时不做任何事"""
+        if not self.enabled:
+            return 0
+
+        data = self._query(zs_code, self.COLUMNS)
+        path = self.path(zs_code)
+        if len(data) == 0:
+            # 空文件无法内存映射，直接删除
+            if os.path.exists(path):
+                os.remove(path)
+            return 0
+
+        # 先写临时文件再替换，已经打开的内存映射仍然指向旧文件
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    def sync_all(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        search = AssetMarketHistory.select(AssetMarketHistory.asset).distinct()
+        codes = [row[0] for row in search.tuples()]
+        for zs_code in codes:
+            self.sync(zs_code)
+
+        return len(codes)
+
+    def load(self, zs_code):
+        """以只读内存映射方式打开资产的缓存文件，未启用或文件不存在时返回 None"""
+        if not self.enabled:
+            return None
+
+        try:
+            return np.load(self.path(zs_code), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def get_history(self, zs_code, start_date=None, end_date=None, columns=('close_price',)):
+        """返回 [start_date, end_date] 内的日期数组和 {字段名: 数组}，空值为 nan"""
+        data = self.load(zs_code)
+        if data is None:
+            # 直接查询数据库时在 SQL 中限定日期范围，不读取范围外的行情
+            data = self._query(zs_code, columns, start_date, end_date)
+            return data['date'], {name: data[name] for name in columns}
+
+        dates = data['date']
+        start, end = 0, len(dates)
+        if start_date is not None:
+            start = np.searchsorted(dates, np.datetime64(start_date, 'D'), side='left')
+        if end_date is not None:
+            end = np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right')
+
+        return dates[start:end], {name: data[name][start:end] for name in columns}
+
+
+PRICE_STORE = PriceStore(os.path.join(DB_DIR, 'prices'))
 
 
 class AccountHistory(BaseModel):
@@ -184,56 +665,93 @@ class AccountHistory(BaseModel):
         return set([record.account for record in cls.select(cls.account).distinct()])
 
     @classmethod
-    def get_summary(cls, accounts=None, date=None):
-        now = datetime.now()
-        if date is None:
-            date = now.date() if now.hour >= 20 else now.date() - timedelta(days=1)
+    def get_latest_records(cls, accounts, dates):
+        """一次查询得到各账户在每个日期（含）之前的最后一条记录
+
+        每个日期对应一个按账户分区、按日期倒序编号的窗口查询，用 UNION ALL 合并后只取编号为 1 的行，
+        返回 {(account, date): (account, date, amount, money, nav, cash, position)}。
+        """
+        subqueries = []
+        for date in dates:
+            rank = fn.ROW_NUMBER().over(partition_by=[cls.account], order_by=[cls.date.desc()])
+            subquery = cls.select(
+                cls.account, cls.date, cls.amount, cls.money, cls.nav, cls.cash, cls.position,
+                Value(date, converter=cls.date.db_value).alias('as_of'),
+                rank.alias('rank'),
+            ).\
+                where(cls.account.in_(list(accounts))).\
+                where(cls.date <= date)
+            subqueries.append(subquery)
+
+        results = {}
+        if not subqueries:
+            return results
+
+        union = reduce(operator.add, subqueries).alias('latest')
+        search = Select(from_list=[union], columns=[SQL('*')]).\
+            where(union.c.rank == 1).\
+            bind(DATABASE)
+        for row in search.tuples():
+            record = (row[0], cls.date.python_value(row[1])) + tuple(row[2:7])
+            results[(row[0], cls.date.python_value(row[7]))] = record
+
+        return results
+
+    @classmethod
+    def get_summaries(cls, accounts=None, dates=None):
+        """批量计算多个日期的账户汇总数据
 
+        返回 {date: summary}，summary 为所有账户的汇总，其中 `details` 为各账户各自的汇总；
+        某个日期所有账户都没有记录时对应的值为 None。
+        """
+        if not dates:
+            now = datetime.now()
+            dates = [now.date() if now.hour >= 20 else now.date() - timedelta(days=1)]
+
+        dates = list(dict.fromkeys(dates))
         accounts = accounts or cls.all_acounts()
-        records = []
-        for account in accounts:
-            search = cls.select().where(cls.account == account)
-            search = search.where(cls.date <= date)
-            search = search.order_by(cls.date.desc())
-            record = search.first()
-            if record is None:
-                LOGGER.info('no history record for account %s at %s', account, date)
+        ledgers = CashFlowLedger.load_many(accounts)
+        total_ledger = CashFlowLedger.merge(ledgers.values())
+        latest_records = cls.get_latest_records(accounts, dates)
+
+        summaries, cash_flows = {}, []
+        for date in dates:
+            records = []
+            for account in accounts:
+                record = latest_records.get((account, date))
+                if record is None:
+                    LOGGER.info('no history record for account %s at %s', account, date)
+                    continue
+
+                _, record_date, amount, money, nav, cash, position = record
+                cash_flow = ledgers[account].get_cash_flow(date)
+                cash_flow[date] += money
+                cash_flows.append(cash_flow)
+                records.append({
+                    'account': account,
+                    'date': record_date,
+                    'amount': round(amount, 2),
+                    'money': round(money, 2),
+                    'return': round(money - amount, 2),
+                    'return_rate': round(nav - 1, 4),
+                    'cash': round(cash, 2),
+                    'position': round(position, 4),
+                    'annualized_return': None,
+                })
+
+            if not records:
+                summaries[date] = None
                 continue
 
-            cash_flow = Deal.get_cash_flow([account], date)
-            cash_flow[date] += record.money
-            start_date = min(cash_flow.keys())
-            annualized_return = None
-            if (date - start_date).days >= 30:
-                annualized_return = xirr(sorted(cash_flow.items(), key=itemgetter(0)))
-                annualized_return = round(annualized_return, 4)
-
-            records.append({
-                'account': record.account,
-                'date': record.date,
-                'amount': round(record.amount, 2),
-                'money': round(record.money, 2),
-                'return': round(record.money - record.amount, 2),
-                'return_rate': round(record.nav - 1, 4),
-                'cash': round(record.cash, 2),
-                'position': round(record.position, 4),
-                'annualized_return': annualized_return,
-            })
-
-        if records:
             total_invested = sum([item['amount'] for item in records])
             total_cash = sum([item['cash'] for item in records])
             total_money = sum([item['money'] for item in records])
-            cash_flow = Deal.get_cash_flow(accounts, date)
+            cash_flow = total_ledger.get_cash_flow(date)
             cash_flow[date] += total_money
-            start_date = min(cash_flow.keys())
-            annualized_return = None
-            if (date - start_date).days >= 30:
-                annualized_return = xirr(sorted(cash_flow.items(), key=itemgetter(0)))
-                annualized_return = round(annualized_return, 4)
+            cash_flows.append(cash_flow)
 
             position = 1 - total_cash / total_money if abs(total_money) > 0.0001 else 0.0
-            return {
+            summaries[date] = {
                 'accounts': accounts,
                 'date': max(records, key=itemgetter('date'))['date'],
                 'amount': round(total_invested, 2),
@@ -242,10 +760,30 @@ class AccountHistory(BaseModel):
                 'return_rate': round(total_money / total_invested - 1, 4),
                 'cash': round(total_cash, 2),
                 'position': round(position, 4),
-                'annualized_return': annualized_return,
+                'annualized_return': None,
+                'details': records,
             }
 
-        return None
+        # 所有日期、所有账户及总计的年化收益率一起求解，顺序与 cash_flows 一致
+        annualized_returns = iter(get_annualized_returns(cash_flows))
+        for summary in summaries.values():
+            if summary is None:
+                continue
+
+            for record in summary['details']:
+                record['annualized_return'] = next(annualized_returns)
+
+            summary['annualized_return'] = next(annualized_returns)
+
+        return summaries
+
+    @classmethod
+    def get_summary(cls, accounts=None, date=None):
+        now = datetime.now()
+        if date is None:
+            date = now.date() if now.hour >= 20 else now.date() - timedelta(days=1)
+
+        return cls.get_summaries(accounts, [date])[date]
 
 
 class AccountAssetsHistory(BaseModel):
@@ -274,59 +812,270 @@ class AccountAssetsHistory(BaseModel):
         return list(search)
 
     @classmethod
-    def get_assets(cls, accounts, date=None):
-        asset2amount, asset2cost = defaultdict(float), defaultdict(float)
-        for account in accounts:
-            for record in cls.get_account_assets(account, date=date):
-                asset2amount[record.asset] += record.amount
-                if record.asset.zs_code != 'CASH':
-                    asset2cost[record.asset] += record.cost
+    def _snapshot_query(cls, accounts, date, index):
+        latest = cls.select(cls.account, fn.MAX(cls.date).alias('max_date')).\
+            where(cls.account.in_(list(accounts)))
+        if date:
+            latest = latest.where(cls.date <= date)
 
-        results = {}
-        for asset, amount in asset2amount.items():
-            amount = amount if abs(amount) > 0.001 else 0
-            cost = asset2cost[asset] if abs(asset2cost[asset]) > 0.001 else 0
-            results[asset] = {
-                'code': asset.zs_code,
-                'name': asset.name,
-                'amount': amount,
+        latest = latest.group_by(cls.account).alias(f'latest_{index}')
+
+        history = AssetMarketHistory.alias()
+        price = Case(
+            None,
+            [(fn.SUBSTR(history.asset, -2) == 'OF', history.nav)],
+            history.close_price
+        )
+
+        def as_of(column):
+            search = history.select(column).\
+                where(history.asset == cls.asset).\
+                where(price.is_null(False))
+            if date:
+                search = search.where(history.date <= date)
+
+            return search.order_by(history.date.desc()).limit(1)
+
+        return cls.select(
+            Value(index).alias('index'),
+            cls.account, Asset.zs_code, Asset.name, Asset.category, cls.amount, cls.cost,
+            as_of(price).alias('price'), as_of(history.date).alias('price_date'),
+        ).\
+            join(Asset).\
+            switch(cls).\
+            join(latest, on=(
+                (cls.account == latest.c.account) & (cls.date == latest.c.max_date)
+            ))
+
+    @classmethod
+    def get_snapshots(cls, accounts, dates):
+        """一次查询得到多个账户在多个日期（含）之前最后一天的持仓及各资产当时的价格
+
+        每个账户取最后一个快照日期的全部持仓；价格通过 (asset, date) 索引上的关联子查询取
+        对应日期及之前最近一个非空价格，场外基金取单位净值，其他品种取收盘价。
+        各日期的查询用 UNION ALL 合并，结果中的 `index` 列为对应日期在 `dates` 中的下标。
+        """
+        columns = [
+            'index', 'account', 'code', 'name', 'category', 'amount', 'cost', 'price', 'price_date'
+        ]
+        if not dates:
+            return pd.DataFrame([], columns=columns)
+
+        search = reduce(operator.add, [
+            cls._snapshot_query(accounts, date, idx) for idx, date in enumerate(dates)
+        ])
+        return pd.DataFrame(list(search.tuples()), columns=columns)
+
+    @classmethod
+    def _valuate(cls, snapshot, date):
+        if snapshot.empty:
+            return []
+
+        snapshot = snapshot.assign(
+            cost=snapshot['cost'].fillna(0).where(snapshot['code'] != 'CASH', 0)
+        )
+        assets = snapshot.groupby(['code', 'name', 'category'], as_index=False, sort=True).agg(
+            amount=('amount', 'sum'), cost=('cost', 'sum'),
+            price=('price', 'first'), price_date=('price_date', 'first'),
+        )
+
+        is_cash = (assets['code'] == 'CASH').to_numpy()
+        fixed = is_cash | (assets['category'] == 'other').to_numpy()
+        amount = assets['amount'].to_numpy(dtype=float)
+        raw_cost = assets['cost'].to_numpy(dtype=float)
+        amount = np.where(np.abs(amount) > 0.001, amount, 0)
+        cost = np.where(np.abs(raw_cost) > 0.001, raw_cost, 0)
+        price = np.where(fixed, 1.0, assets['price'].to_numpy(dtype=float))
+        has_price = ~np.isnan(price)
+
+        # 舍入使用 Python 内置的 round，和逐条计算时的结果保持一致
+        money = [
+            value if cash else round(value, 2)
+            for value, cash in zip((amount * np.nan_to_num(price)).tolist(), is_cash)
+        ]
+        returns = np.array(money) - cost
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return_rate = (returns / cost).tolist()
+            avg_cost = (cost / amount).tolist()
+
+        results = []
+        for idx, (code, name) in enumerate(zip(assets['code'], assets['name'])):
+            item = {
+                'code': code,
+                'name': name,
+                'amount': float(amount[idx]) if amount[idx] else 0,
                 'money': None,
-                'cost': cost,
+                'cost': float(cost[idx]) if cost[idx] else 0,
                 'avg_cost': None,
                 'price': None,
                 'price_date': None,
                 'return': None,
                 'return_rate': None
             }
-            price, price_date = asset.get_price(date)
-
-            if price is None:
-                LOGGER.warning('no price found for asset %s at %s', asset, date)
-                results[asset].update({
-                    'money': asset2cost[asset],
-                })
+            results.append(item)
+            if not has_price[idx]:
+                LOGGER.warning('no price found for asset %s at %s', code, date)
+                item['money'] = float(raw_cost[idx])
                 continue
 
-            results[asset].update({
-                'price': price,
-                'price_date': price_date
-            })
-            if asset.zs_code == 'CASH':
-                results[asset].update({
-                    'money': amount,
-                    'cost': None,
-                    'price_date': None,
-                })
+            item['price'] = float(price[idx])
+            if is_cash[idx]:
+                item.update({'money': float(amount[idx]), 'cost': None})
                 continue
 
-            results[asset]['money'] = round(amount * price, 2)
-            results[asset]['return'] = results[asset]['money'] - cost
-            if cost > 0 and amount > 0:
-                results[asset]['return_rate'] = round(results[asset]['return'] / cost, 4)
-            if amount > 0:
-                results[asset]['avg_cost'] = round(cost / amount, 4)
+            if fixed[idx]:
+                item['price_date'] = date
+            else:
+                item['price_date'] = AssetMarketHistory.date.python_value(
+                    assets['price_date'].iloc[idx]
+                )
+
+            item['money'] = money[idx]
+            item['return'] = float(returns[idx])
+            if cost[idx] > 0 and amount[idx] > 0:
+                item['return_rate'] = round(return_rate[idx], 4)
+            if amount[idx] > 0:
+                item['avg_cost'] = round(avg_cost[idx], 4)
+
+        return results
+
+    @classmethod
+    def get_assets_many(cls, accounts, dates):
+        """批量计算多个日期的持仓明细，返回 {date: assets}"""
+        dates = list(dict.fromkeys(dates))
+        snapshots = cls.get_snapshots(accounts, dates)
+        return {
+            date: cls._valuate(snapshots[snapshots['index'] == idx], date)
+            for idx, date in enumerate(dates)
+        }
+
+    @classmethod
+    def get_assets(cls, accounts, date=None):
+        return cls.get_assets_many(accounts, [date])[date]
+
+
+class AccountAssetValueHistory(BaseModel):
+    """账户中每个资产每个交易日的持仓市值，和 AccountHistory 在同一次计算中生成"""
+
+    account = CharField()
+    asset = ForeignKeyField(Asset, backref='value_history', index=False)
+    date = DateField(index=True)
+    amount = FloatField()            # 持有份额
+    price = FloatField()             # 价格
+    money = FloatField()             # 市值
+    cost = FloatField(null=True)     # 投入，现金为空
+    profit = FloatField(null=True)   # 浮动盈亏，现金为空
+
+    class Meta:
+        # 主键即 (account, asset, date) 上的索引，单个资产的历史可以直接按范围读取
+        primary_key = CompositeKey('account', 'asset', 'date')
+
+    @classmethod
+    def get_history(cls, account, zs_code, start_date=None, end_date=None):
+        search = cls.select().where(cls.account == account).where(cls.asset == zs_code)
+        if start_date:
+            search = search.where(cls.date >= start_date)
+        if end_date:
+            search = search.where(cls.date <= end_date)
+
+        return list(search.order_by(cls.date))
+
+
+class AccountWatermark(BaseModel):
+    """记录每个账户因交易或行情变动而需要重新计算的最早日期
+
+    由 `install_triggers` 创建的触发器在 Deal 和 AssetMarketHistory 写入时自动维护，
+    `update-accounts` 据此只重算受影响日期之后的数据。
+    """
+
+    account = CharField(primary_key=True)
+    date = DateField()               # 受影响的最早日期
+
+    TRIGGERS = [
+        (
+            'deal_after_insert', 'AFTER INSERT ON deal',
+            ["VALUES (NEW.account, date(NEW.time))"],
+        ),
+        (
+            'deal_after_update', 'AFTER UPDATE ON deal',
+            ["VALUES (OLD.account, date(OLD.time))", "VALUES (NEW.account, date(NEW.time))"],
+        ),
+        (
+            'deal_after_delete', 'AFTER DELETE ON deal',
+            ["VALUES (OLD.account, date(OLD.time))"],
+        ),
+        (
+            'assetmarkethistory_after_insert', 'AFTER INSERT ON assetmarkethistory',
+            ["SELECT DISTINCT account, NEW.date FROM deal WHERE asset_id = NEW.asset_id"],
+        ),
+        (
+            'assetmarkethistory_after_update', 'AFTER UPDATE ON assetmarkethistory',
+            ["SELECT DISTINCT account, NEW.date FROM deal WHERE asset_id = NEW.asset_id"],
+        ),
+    ]
+
+    @classmethod
+    def install_triggers(cls):
+        table = cls._meta.table_name
+        for name, event, sources in cls.TRIGGERS:
+            statements = [
+                f'INSERT INTO {table} (account, date) {source} '
+                f'ON CONFLICT (account) DO UPDATE SET date = MIN(date, excluded.date);'
+                for source in sources
+            ]
+            cls._meta.database.execute_sql(
+                f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {" ".join(statements)} END'
+            )
+
+    @classmethod
+    def get_dates(cls, accounts):
+        search = cls.select().where(cls.account.in_(list(accounts)))
+        return {record.account: record.date for record in search}
+
+    @classmethod
+    def clear(cls, account, date):
+        """清除账户的标记，若期间有新的变动使标记日期改变则保留"""
+        cls.delete().where(cls.account == account).where(cls.date == date).execute()
+
+
+class AssetPriceVersion(BaseModel):
+    """每个资产的行情变动计数
+
+    由 `install_triggers` 创建的触发器在 AssetMarketHistory 写入、修改或删除时递增，
+    PriceBook 据此判断缓存的价格是否过期，原地修正的价格也能被发现。
+    """
+
+    asset = ForeignKeyField(Asset, primary_key=True)
+    version = IntegerField(default=0)
+
+    TRIGGERS = [
+        ('assetpriceversion_after_insert', 'AFTER INSERT ON assetmarkethistory', ['NEW']),
+        ('assetpriceversion_after_update', 'AFTER UPDATE ON assetmarkethistory', ['OLD', 'NEW']),
+        ('assetpriceversion_after_delete', 'AFTER DELETE ON assetmarkethistory', ['OLD']),
+    ]
+
+    @classmethod
+    def install_triggers(cls):
+        table = cls._meta.table_name
+        for name, event, rows in cls.TRIGGERS:
+            statements = [
+                f'INSERT INTO {table} (asset_id, version) VALUES ({row}.asset_id, 1) '
+                f'ON CONFLICT (asset_id) DO UPDATE SET version = version + 1;'
+                for row in rows
+            ]
+            cls._meta.database.execute_sql(
+                f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {" ".join(statements)} END'
+            )
+
+    @classmethod
+    def get_version(cls, zs_code):
+        return cls.select(cls.version).where(cls.asset == zs_code).scalar() or 0
+
+
+class CalendarDay(BaseModel):
 
-        return list(results.values())
+    date = DateField(primary_key=True)
+    is_trading = BooleanField()      # 是否为交易日
 
 
 class QiemanAsset(BaseModel):
@@ -0,0 +1,455 @@
+"""券商交易记录解析
+
+每个券商的解析器是一个生成器函数，读取导出文件并逐条产生 `DealRecord`，
+通过 `register_parser` 注册到 `PARSERS` 中。`parse_statements` 负责公共的处理流程：
+补全证券代码后缀、按时间排序（分批排序后写入临时文件再归并，内存占用与文件大小无关）
+以及输出为 import-deals 使用的 TSV 格式，多个输入文件在进程池中并行解析。
+
+解析器在工作进程中执行，不能访问数据库。需要查询数据库或者汇总所有输入文件才能确定的记录，
+解析器产生 `PendingRecord`，由 `register_resolver` 注册的同名处理函数在主进程中统一处理。
+"""
+import os
+import re
+import csv
+import json
+import heapq
+import pickle
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from operator import itemgetter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from peewee import chunked
+
+from .models import Asset, AssetMarketHistory
+from .utils import get_code_suffix
+
+
+LOGGER = logging.getLogger(__name__)
+PARSERS = {}
+RESOLVERS = {}
+
+
+class DealRecord(NamedTuple):
+
+    account: str
+    sub_account: str
+    time: datetime
+    code: str
+    name: str
+    action: str
+    amount: float
+    price: float
+    money: float
+    fee: float
+
+
+class PendingRecord(NamedTuple):
+
+    kind: str
+    data: tuple
+
+
+def register_parser(name):
+    """将解析器注册为 `name`，解析器接受输入文件路径和解析参数，产生 DealRecord/PendingRecord"""
+    def decorator(func):
+        PARSERS[name] = func
+        return func
+
+    return decorator
+
+
+def register_resolver(name):
+    """注册 `name` 解析器的 PendingRecord 处理函数，处理函数接受所有 PendingRecord，产生 DealRecord"""
+    def decorator(func):
+        RESOLVERS[name] = func
+        return func
+
+    return decorator
+
+
+@register_parser('qieman')
+def parse_qieman(infile, add_transfer=False):
+    """解析 export-qieman-orders 导出的且慢订单记录
+
+    `add_transfer` 为真时，按账户和日期汇总买入金额，产生等额的资金转入。
+    红利再投资、基金转换和资金转入记录需要查询数据库或汇总所有文件，作为 PendingRecord 产生。
+    """
+    pattern = re.compile(r'再投资份额(\d+\.\d+)份')
+    transfer_in = defaultdict(float)
+    with open(infile) as fin:
+        for line in fin:
+            item = json.loads(line)
+            account = item['umaName']
+            sub_account = item['capitalAccountName']
+            if item['capitalAccountName'] == '货币三佳':
+                pass
+            elif item['hasDetail']:
+                if item['orderStatus'] != 'SUCCESS':
+                    continue
+
+                for order in item['compositionOrders']:
+                    value = order['nav']
+                    fee = order['fee']
+                    order_time = datetime.fromtimestamp(order['acceptTime'] / 1000)
+                    count = order['uiShare']
+                    money = order['uiAmount']
+                    action = 'unknown'
+                    if order['payStatus'] == '2':
+                        action = 'buy'
+                    elif order['payStatus'] == '0':
+                        action = 'sell'
+
+                    fund_code = order['fund']['fundCode']
+                    fund_name = order['fund']['fundName']
+                    if fund_name.find('广发钱袋子') >= 0:  # FIXME: 应当用基金类型来判断
+                        continue
+
+                    if 'destFund' in order:
+                        money -= fee
+                        yield PendingRecord('conversion', (
+                            account, sub_account, order_time,
+                            order['destFund']['fundCode'], order['destFund']['fundName'],
+                            money
+                        ))
+                    elif add_transfer and action == 'buy':
+                        transfer_in[(account, str(order_time.date()))] += money
+
+                    yield DealRecord(
+                        account, sub_account, order_time, f'{fund_code}.OF', fund_name,
+                        action, count, value, money, fee
+                    )
+            elif item['uiOrderDesc'].find('再投资') >= 0:
+                order_time = datetime.fromtimestamp(item['acceptTime'] / 1000)
+                count = float(pattern.findall(item['uiOrderDesc'])[0])
+                money = item['uiAmount']
+                value = round(float(money) / float(count), 4)
+                fund_code = item['fund']['fundCode']
+                yield PendingRecord('reinvest', (
+                    fund_code,
+                    DealRecord(
+                        account, sub_account, order_time, f'{fund_code}.OF',
+                        item['fund']['fundName'], 'reinvest', count, value, money, 0
+                    ),
+                ))
+            elif item['uiOrderCodeName'].find('现金分红') >= 0:
+                order_time = datetime.fromtimestamp(item['acceptTime'] / 1000)
+                yield DealRecord(
+                    account, sub_account, order_time,
+                    f'{item["fund"]["fundCode"]}.OF', item['fund']['fundName'],
+                    'bonus', item['uiAmount'], 1.0, item['uiAmount'], 0.0
+                )
+
+    for (account, date), money in transfer_in.items():
+        yield PendingRecord('transfer', (account, date, money))
+
+
+@register_resolver('qieman')
+def resolve_qieman(pending):
+    transfer_in = defaultdict(float)
+    conversions = []
+    for item in pending:
+        if item.kind == 'transfer':
+            account, date, money = item.data
+            transfer_in[(account, date)] += money
+        elif item.kind == 'conversion':
+            conversions.append(item.data)
+        elif item.kind == 'reinvest':
+            yield correct_reinvest_time(*item.data)
+
+    for (account, date), money in transfer_in.items():
+        order_time = datetime.strptime(f'{date} 08:00:00', '%Y-%m-%d %H:%M:%S')
+        yield DealRecord(
+            account, '', order_time, 'CASH', '现金',
+            'transfer_in', money, 1.0, money, 0.0
+        )
+
+    for account, sub_account, order_time, code, name, money in conversions:
+        fund = Asset.get_or_none(zs_code=f'{code}.OF')
+        if not fund:
+            LOGGER.warning(
+                "fund `%s` is not found in database, add it with `update-fund`",
+                code
+            )
+            continue
+
+        close_time = datetime.strptime(f'{order_time.date()} 15:00:00', '%Y-%m-%d %H:%M:%S')
+        if order_time > close_time:
+            history_date = order_time.date() + timedelta(days=1)
+        else:
+            history_date = order_time.date()
+
+        history_records = list(fund.history.where(AssetMarketHistory.date == history_date))
+        if not history_records:
+            LOGGER.warning(
+                "history data of fund `%s` is not found in database, try `update-fund`",
+                code
+            )
+            continue
+
+        value = history_records[0].nav
+        count = round(money / value, 2)
+        yield DealRecord(
+            account, sub_account, order_time, f'{code}.OF', name,
+            'buy', count, value, money, 0.0
+        )
+
+
+def correct_reinvest_time(fund_code, record):
+    """且慢交易记录里红利再投资日期是再投资到账日期，不是实际发生的日期，
+    这里尝试根据净值往前查找得到真正的日期
+    """
+    order_time, value = record.time, record.price
+    fund = Asset.get_or_none(code=f'{fund_code}.OF')
+    if not fund:
+        LOGGER.warning(
+            "can not guess real order time of reinvestment(code: %s;time: %s; nav: %s)",
+            fund_code, order_time, value
+        )
+        return record
+
+    search = fund.history.where(AssetMarketHistory.date < order_time.date())
+    search = search.where(
+        AssetMarketHistory.date >= order_time.date() - timedelta(days=10)
+    )
+    search = search.order_by(AssetMarketHistory.date.desc())
+    candidates = []
+    for history in search[:3]:
+        candidates.append((history, abs(history.nav - value)))
+
+    history, nav_diff = min(candidates, key=itemgetter(1))
+    LOGGER.info(
+        "correct reinvestment time of `%s` from `%s` to `%s`(nav diff: %f)",
+        fund_code, order_time, history.date, nav_diff
+    )
+    order_time = datetime.strptime(f'{history.date} 08:00:00', '%Y-%m-%d %H:%M:%S')
+    return record._replace(time=order_time, price=history.nav)
+
+
+@register_parser('pingan')
+def parse_pingan(infile):
+    """解析平安证券的交易记录"""
+    action_mappings = {
+        '证券买入': 'buy',
+        '证券卖出': 'sell',
+        '银证转入': 'transfer_in',
+        '银证转出': 'transfer_out',
+        '利息归本': 'reinvest',
+    }
+    with open(infile) as fin:
+        reader = csv.DictReader(fin)
+        for row in reader:
+            if row['操作'] not in action_mappings:
+                LOGGER.warning("unsupported action: %s", row['操作'])
+                continue
+
+            order_time = datetime.strptime(f'{row["成交日期"]} {row["成交时间"]}', '%Y%m%d %H:%M:%S')
+            action = action_mappings[row['操作']]
+            code, name = row['证券代码'], row['证券名称']
+            count, price = float(row['成交数量']), float(row['成交均价'])
+            money = float(row['发生金额'].lstrip('-'))
+            fee = float(row["手续费"]) + float(row["印花税"])
+            if action.startswith('transfer') or action == 'reinvest':
+                code, name, count, price = 'CASH', '现金', money, 1.0
+
+            yield DealRecord(
+                '平安证券', '平安证券', order_time, code, name,
+                action, count, price, money, fee
+            )
+
+
+@register_parser('huabao')
+def parse_huabao(infile):
+    """解析华宝证券的交易记录
+
+    打新股/打新债的中签扣款使用的是申购代码，需要根据托管转入记录换成上市后的代码，
+    中签扣款和托管记录可能在不同的文件中，作为 PendingRecord 产生。
+    """
+    ignore_actions = set(['中签通知', '配号'])
+    action_mappings = {
+        '买入': 'buy',
+        '卖出': 'sell',
+        '中签扣款': 'buy',
+    }
+    with open(infile) as fin:
+        reader = csv.DictReader(fin)
+        for row in reader:
+            if row['委托类别'] in ignore_actions:
+                continue
+
+            if row['委托类别'] not in action_mappings:
+                # 将打新股/打新债的扣款、托管相关的交易记录另外记录待之后处理
+                if row['委托类别'] in ('托管转入', '托管转出'):
+                    yield PendingRecord('custody', (
+                        row['委托类别'], row['证券代码'], row['证券名称'], row['成交编号']
+                    ))
+                    continue
+                else:
+                    LOGGER.warning("unsupported action: %s", row)
+
+                continue
+
+            order_time = datetime.strptime(f'{row["成交日期"]} {row["成交时间"]}', '%Y%m%d %H:%M:%S')
+            action = action_mappings[row['委托类别']]
+            money, fee = float(row['发生金额']), float(row['佣金']) + float(row['印花税'])
+            if action == 'buy':
+                money += fee
+            elif action == 'sell':
+                money -= fee
+
+            # 有些品种用「手」作为单位，将其转换为「股」
+            count, price = float(row['成交数量']), float(row['成交价格'])
+            if abs(money / (float(count) * float(price)) - 10) < 0.5:
+                count = float(count) * 10
+
+            record = DealRecord(
+                '华宝证券', '华宝证券', order_time, row['证券代码'], row['证券名称'],
+                action, count, price, money, fee
+            )
+            if row['委托类别'] == '中签扣款':
+                yield PendingRecord('subscription', (record,))
+            else:
+                yield record
+
+
+@register_resolver('huabao')
+def resolve_huabao(pending):
+    name2codes = defaultdict(dict)
+    subscriptions = []
+    for item in pending:
+        if item.kind == 'subscription':
+            subscriptions.append(item.data[0])
+            continue
+
+        category, code, name, deal_id = item.data
+        if not name.strip():
+            continue
+
+        if category == '托管转出' and deal_id == '清理过期数据':
+            name2codes[name]['origin'] = code
+        elif category == '托管转入':
+            suffix = get_code_suffix(code)
+            name2codes[name]['new'] = code + f'.{suffix}'
+
+    code_mappings = {}
+    for codes in name2codes.values():
+        code_mappings[codes['origin']] = codes['new']
+
+    for record in subscriptions:
+        if record.code in code_mappings:
+            LOGGER.info("convert code from `%s` to `%s`", record.name, code_mappings[record.code])
+            record = record._replace(code=code_mappings[record.code])
+
+        yield record
+
+
+def normalize_record(record):
+    """为没有后缀的场内证券代码加上交易所后缀"""
+    if record.code == 'CASH' or '.' in record.code:
+        return record
+
+    suffix = get_code_suffix(record.code)
+    if suffix is None:
+        return record
+
+    return record._replace(code=f'{record.code}.{suffix}')
+
+
+def get_sort_key(record):
+    return record.time, record.account, record.sub_account, record.code, record.action
+
+
+def format_record(record):
+    return '\t'.join([
+        '\t'.join(map(str, record[:6])),
+        f'{record.amount:0.2f}', f'{record.price:0.4f}',
+        f'{record.money:0.2f}', f'{record.fee:0.2f}',
+    ])
+
+
+def write_sorted_runs(records, directory, chunk_size):
+    """每 `chunk_size` 条记录排序后写入 `directory` 下的一个临时文件，返回文件路径列表"""
+    runs = []
+    for chunk in chunked(records, chunk_size):
+        chunk.sort(key=get_sort_key)
+        with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.run', delete=False) as fout:
+            for record in chunk:
+                pickle.dump(tuple(record), fout, pickle.HIGHEST_PROTOCOL)
+
+        runs.append(fout.name)
+
+    return runs
+
+
+def read_sorted_run(path):
+    with open(path, 'rb') as fin:
+        while True:
+            try:
+                yield DealRecord(*pickle.load(fin))
+            except EOFError:
+                return
+
+
+def parse_to_runs(broker, infile, options, directory, chunk_size):
+    """解析单个文件并写入排好序的临时文件，返回 (临时文件列表, PendingRecord 列表)
+
+    在工作进程中执行，不访问数据库。
+    """
+    pending = []
+
+    def records():
+        for record in PARSERS[broker](infile, **options):
+            if isinstance(record, PendingRecord):
+                pending.append(record)
+            else:
+                yield normalize_record(record)
+
+    runs = write_sorted_runs(records(), directory, chunk_size)
+    LOGGER.info(
+        "parsed %s with `%s` parser into %d sorted runs and %d pending records",
+        infile, broker, len(runs), len(pending)
+    )
+    return runs, pending
+
+
+def parse_statements(broker, infiles, outfile, workers=None, chunk_size=100000, **options):
+    """用 `broker` 解析器解析 `infiles` 并将按时间排序的交易记录写入 `outfile`
+
+    多个输入文件在最多 `workers` 个进程中并行解析，返回写入的记录数。
+    """
+    if broker not in PARSERS:
+        raise ValueError(f'unknown broker: {broker}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        if len(infiles) > 1 and workers != 1:
+            workers = workers or min(len(infiles), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(parse_to_runs, broker, infile, options, directory, chunk_size)
+                    for infile in infiles
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [
+                parse_to_runs(broker, infile, options, directory, chunk_size)
+                for infile in infiles
+            ]
+
+        runs = [run for cur_runs, _ in results for run in cur_runs]
+        pending = [record for _, cur_pending in results for record in cur_pending]
+        resolved = []
+        if pending:
+            resolved = [normalize_record(record) for record in RESOLVERS[broker](pending)]
+            resolved.sort(key=get_sort_key)
+
+        count = 0
+        with open(outfile, 'w') as fout:
+            sources = [read_sorted_run(run) for run in runs] + [resolved]
+            for record in heapq.merge(*sources, key=get_sort_key):
+                print(format_record(record), file=fout)
+                count += 1
+
+    return count
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+from chinese_calendar import is_holiday
+from peewee import chunked, fn
+
+from .models import (
+    DATABASE,
+    AssetMarketHistory,
+    CalendarDay,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def to_date(value):
+    """将 datetime/pandas.Timestamp/numpy.datetime64 等转换为 date"""
+    if isinstance(value, np.datetime64):
+        return value.astype('datetime64[D]').item()
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+
+    return value.to_pydatetime().date()
+
+
+def is_holiday_data_covered(cur_date):
+    """节假日数据是否覆盖 `cur_date` 所在的年份"""
+    try:
+        is_holiday(cur_date)
+    except NotImplementedError:
+        return False
+
+    return True
+
+
+def compute_trading_days(start_date, end_date, with_coverage=False):
+    """计算 [start_date, end_date] 内每一天是否为交易日
+
+    节假日数据覆盖的年份按「工作日且不是法定节假日」判断，其他年份以当天是否有行情数据为准。
+    `with_coverage` 为真时同时返回每一天是否有节假日数据。
+    """
+    market_dates = None
+    results, coverage = [], []
+    for offset in range((end_date - start_date).days + 1):
+        cur_date = start_date + timedelta(days=offset)
+        try:
+            results.append(cur_date.weekday() < 5 and not is_holiday(cur_date))
+            coverage.append(True)
+        except NotImplementedError:
+            if market_dates is None:
+                search = AssetMarketHistory.select(AssetMarketHistory.date).distinct().\
+                    where(AssetMarketHistory.date >= start_date).\
+                    where(AssetMarketHistory.date <= end_date)
+                market_dates = set(item[0] for item in search.tuples())
+
+            results.append(cur_date in market_dates)
+            coverage.append(False)
+
+    if with_coverage:
+        return np.array(results, dtype=bool), np.array(coverage, dtype=bool)
+
+    return np.array(results, dtype=bool)
+
+
+class TradingCalendar:
+    """交易日历
+
+    交易日保存在 CalendarDay 表中，使用时一次性加载为以 `start` 为起点、按天偏移的位图，
+    表中没有的日期在用到时计算并补充到内存中。图表使用的 rangebreaks 按日期范围缓存。
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._start = None
+        self._bits = np.zeros(0, dtype=bool)
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        rows = []
+        # 未执行 migrate-db 的旧数据库中没有这张表，此时全部在内存中计算
+        if CalendarDay.table_exists():
+            search = CalendarDay.select(CalendarDay.date, CalendarDay.is_trading).\
+                order_by(CalendarDay.date)
+            rows = list(search.tuples())
+
+        self._start, self._bits = None, np.zeros(0, dtype=bool)
+        if rows:
+            # 表中的日期应当是连续的，有缺失时只使用第一段连续的部分
+            self._start = rows[0][0]
+            days = [(row[0] - self._start).days for row in rows]
+            size = len(days)
+            if days[-1] != size - 1:
+                size = next(idx for idx, day in enumerate(days) if day != idx)
+
+            self._bits = np.array([row[1] for row in rows[:size]], dtype=bool)
+
+        self._loaded_at = time.time()
+        self._rangebreaks.cache_clear()
+
+    def _ensure(self, start_date, end_date):
+        """确保位图覆盖 [start_date, end_date]，返回位图的起始日期和位图"""
+        with self._lock:
+            if self._loaded_at is None or time.time() - self._loaded_at > self.ttl:
+                self._load()
+
+            if self._start is None:
+                self._start = start_date
+                self._bits = compute_trading_days(start_date, end_date)
+                return self._start, self._bits
+
+            cur_end = self._start + timedelta(days=len(self._bits) - 1)
+            if start_date < self._start:
+                head = compute_trading_days(start_date, self._start - timedelta(days=1))
+                self._start, self._bits = start_date, np.concatenate([head, self._bits])
+            if end_date > cur_end:
+                tail = compute_trading_days(cur_end + timedelta(days=1), end_date)
+                self._bits = np.concatenate([self._bits, tail])
+
+            return self._start, self._bits
+
+    def _slice(self, start_date, end_date):
+        start, bits = self._ensure(start_date, end_date)
+        offset = (start_date - start).days
+        return bits[offset:offset + (end_date - start_date).days + 1]
+
+    def is_trading_day(self, cur_date):
+        cur_date = to_date(cur_date)
+        return bool(self._slice(cur_date, cur_date)[0])
+
+    def trading_mask(self, dates):
+        """批量判断多个日期是否为交易日，`dates` 需要按时间排序"""
+        if len(dates) == 0:
+            return np.zeros(0, dtype=bool)
+
+        start, bits = self._ensure(to_date(dates[0]), to_date(dates[-1]))
+        offsets = np.asarray(dates, dtype='datetime64[D]') - np.datetime64(start, 'D')
+        return bits[offsets.astype(int)]
+
+    def trading_days_between(self, start_date, end_date):
+        """[start_date, end_date] 内的所有交易日"""
+        start_date, end_date = to_date(start_date), to_date(end_date)
+        if start_date > end_date:
+            return []
+
+        bits = self._slice(start_date, end_date)
+        return [start_date + timedelta(days=int(idx)) for idx in np.flatnonzero(bits)]
+
+    @lru_cache(maxsize=256)
+    def _rangebreaks(self, start_date, end_date):
+        bits = self._slice(start_date, end_date)
+        closed_days = [start_date + timedelta(days=int(idx)) for idx in np.flatnonzero(~bits)]
+        return [
+            {'bounds': ['sat', 'mon']},
+            {'values': [day for day in closed_days if day.weekday() < 5]},
+        ]
+
+    def rangebreaks(self, start_date, end_date):
+        """plotly 图表中用于隐藏周末和节假日的 rangebreaks"""
+        return self._rangebreaks(to_date(start_date), to_date(end_date))
+
+    def save(self, start_date, end_date):
+        """计算 [start_date, end_date] 的交易日并写入 CalendarDay 表
+
+        没有节假日数据的年份只能根据行情数据判断，这部分日期只保存到最新的行情日期为止，
+        之后的日期等有了行情数据再计算，保存的日期始终是连续的。
+        """
+        bits, coverage = compute_trading_days(start_date, end_date, with_coverage=True)
+        last_market_date = AssetMarketHistory.select(fn.MAX(AssetMarketHistory.date)).scalar()
+        size = len(bits)
+        for idx in np.flatnonzero(~coverage):
+            cur_date = start_date + timedelta(days=int(idx))
+            if last_market_date is None or cur_date > last_market_date:
+                size = int(idx)
+                break
+
+        rows = [
+            {'date': start_date + timedelta(days=idx), 'is_trading': bool(bit)}
+            for idx, bit in enumerate(bits[:size])
+        ]
+        with DATABASE.atomic():
+            for batch in chunked(rows, 400):
+                CalendarDay.insert_many(batch).on_conflict_replace().execute()
+
+        with self._lock:
+            self._loaded_at = None
+
+        LOGGER.info(
+            'saved %d days from %s to %s into trading calendar',
+            len(rows), start_date, end_date
+        )
+        return len(rows)
+
+    def get_update_start_date(self):
+        """增量更新的起始日期
+
+        从日历中的最后一天开始；最后一天所在的年份没有节假日数据时，
+        从没有节假日数据的最早一年的第一天开始，这些日期需要随着行情数据的补充重新计算。
+        """
+        first_date, last_date = CalendarDay.select(
+            fn.MIN(CalendarDay.date), fn.MAX(CalendarDay.date)
+        ).tuples().get()
+        if last_date is None:
+            return AssetMarketHistory.select(fn.MIN(AssetMarketHistory.date)).scalar()
+
+        start_date = last_date
+        year = last_date.year
+        while year >= first_date.year and not is_holiday_data_covered(date(year, 1, 1)):
+            start_date = max(date(year, 1, 1), first_date)
+            year -= 1
+
+        return start_date
+
+    def update(self, start_date=None, end_date=None):
+        """更新交易日历，默认从 `get_update_start_date` 更新到今年年底"""
+        if start_date is None:
+            start_date = self.get_update_start_date()
+            if start_date is None:
+                LOGGER.warning('no market history in database, skip updating trading calendar')
+                return 0
+
+        if end_date is None:
+            end_date = datetime.now().date().replace(month=12, day=31)
+
+        if start_date > end_date:
+            return 0
+
+        return self.save(start_date, end_date)
+
+
+TRADING_CALENDAR = TradingCalendar()
@@ -1,17 +1,26 @@
 import re
 import logging
+from itertools import groupby
 from operator import itemgetter
 from collections import defaultdict
 from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
+from peewee import fn, chunked
+
 from .models import (
+    DATABASE,
     Deal,
     Asset,
     AssetMarketHistory,
     AccountHistory,
     AccountAssetsHistory,
+    AccountAssetValueHistory,
+    CashFlowLedger,
+    PRICE_BOOK,
 )
+from .trading_calendar import TRADING_CALENDAR
 
 
 LOGGER = logging.getLogger(__name__)
@@ -66,182 +75,529 @@ def get_code_suffix(asset_code):
     return 'unknown'
 
 
-def update_account_assets_history(account, verbse=False):
-    deals = defaultdict(list)
-    for deal in Deal.select().where(Deal.account == account).order_by(Deal.time):
-        date = deal.time.date()
-        deals[date].append(deal)
+DEAL_COLUMNS = [
+    'account', 'sub_account', 'time', 'code', 'name',
+    'action', 'amount', 'price', 'money', 'fee',
+]
+DEAL_ACTIONS = set(action for _, action in Deal.action.choices)
+
+
+def validate_deals_chunk(chunk, asset_codes):
+    """校验一批交易记录，返回 (解析后的 DataFrame, 各行拒绝原因, 各行警告)
+
+    `chunk` 为 (行号, 记录) 的列表，拒绝原因和警告为与 DataFrame 同索引的 Series，没有时为空值。
+    """
+    frame = pd.DataFrame([row for _, row in chunk], columns=DEAL_COLUMNS)
+    frame['line'] = [line for line, _ in chunk]
+    frame['time'] = pd.to_datetime(frame['time'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    numbers = ['amount', 'price', 'money', 'fee']
+    for column in numbers:
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+
+    reasons = pd.Series(None, index=frame.index, dtype=object)
+    checks = [
+        (frame['time'].isna(), 'invalid time'),
+        (frame[numbers].isna().any(axis=1), 'invalid number'),
+        (~frame['code'].isin(asset_codes), 'no asset found for code'),
+        (~frame['action'].isin(DEAL_ACTIONS), 'unknown action'),
+        (
+            (frame['code'] == 'CASH') & ((frame['amount'] - frame['money']).abs() >= 0.001),
+            'cash record is not balanced'
+        ),
+    ]
+    for mask, reason in checks:
+        reasons[mask & reasons.isna()] = reason
+
+    # 买卖金额对不上时仍然导入，只给出警告
+    value = frame['amount'] * frame['price']
+    unbalanced = (
+        (frame['action'] == 'buy') & ((value + frame['fee'] - frame['money']).abs() >= 0.001)
+    ) | (
+        (frame['action'] == 'sell') & ((value - frame['fee'] - frame['money']).abs() >= 0.001)
+    )
+    warnings = pd.Series(None, index=frame.index, dtype=object)
+    warnings[unbalanced & reasons.isna()] = 'record is not balanced'
+    return frame, reasons, warnings
+
+
+def bulk_import_deals(rows, chunk_size=1000):
+    """流式批量导入交易记录
+
+    `rows` 为逐行产生的 10 列记录（账户、子账户、时间、代码、名称、操作、数量、价格、金额、费用），
+    按 `chunk_size` 分块校验，新记录在每块一个事务中用 insert_many 写入。
+    已有的记录按主键 (account, time, asset, amount) 去重。
+
+    返回 (新增数量, 重复数量, 问题记录)，问题记录为
+    {'line': 行号, 'row': 原始记录, 'reason': 原因, 'imported': 是否仍然导入} 的列表。
+    """
+    asset_codes = set(code for code, in Asset.select(Asset.zs_code).tuples())
+    existed_keys, loaded_accounts = set(), set()
+    created_cnt, duplicated_cnt, issues = 0, 0, []
+    for chunk in chunked(enumerate(rows, 1), chunk_size):
+        valid_chunk = []
+        for line, row in chunk:
+            if len(row) != len(DEAL_COLUMNS):
+                issues.append({
+                    'line': line, 'row': row, 'reason': 'column number is not 10', 'imported': False
+                })
+            else:
+                valid_chunk.append((line, row))
+
+        if not valid_chunk:
+            continue
+
+        frame, reasons, warnings = validate_deals_chunk(valid_chunk, asset_codes)
+        line2row = dict(valid_chunk)
+        for line, reason in zip(frame['line'][reasons.notna()], reasons.dropna()):
+            issues.append({
+                'line': int(line), 'row': line2row[line], 'reason': reason, 'imported': False
+            })
+
+        frame = frame.assign(warning=warnings)[reasons.isna()]
+        new_accounts = set(frame['account']) - loaded_accounts
+        if new_accounts:
+            search = Deal.select(Deal.account, Deal.time, Deal.asset, Deal.amount).\
+                where(Deal.account.in_(list(new_accounts)))
+            existed_keys.update(search.tuples())
+            loaded_accounts |= new_accounts
+
+        records = []
+        for item in frame.itertuples(index=False):
+            deal_time = item.time.to_pydatetime()
+            key = (item.account, deal_time, item.code, item.amount)
+            if key in existed_keys:
+                duplicated_cnt += 1
+                continue
 
-    created_cnt, update_cnt = 0, 0
-    code2amount, code2cost, code2asset = defaultdict(float), defaultdict(float), {}
-    for date, date_deals in sorted(deals.items(), key=itemgetter(0)):
-        for item in date_deals:
-            code, action = item.asset.zs_code, item.action
-            if code not in code2asset:
-                code2asset[code] = item.asset
+            existed_keys.add(key)
+            if pd.notna(item.warning):
+                issues.append({
+                    'line': item.line, 'row': line2row[item.line],
+                    'reason': item.warning, 'imported': True,
+                })
 
+            records.append({
+                'account': item.account,
+                'sub_account': item.sub_account,
+                'time': deal_time,
+                'asset': item.code,
+                'action': item.action,
+                'amount': item.amount,
+                'price': item.price,
+                'money': item.money,
+                'fee': item.fee,
+            })
+
+        with DATABASE.atomic():
+            for batch in chunked(records, 100):
+                Deal.insert_many(batch).execute()
+
+        created_cnt += len(records)
+
+    issues.sort(key=itemgetter('line'))
+    return created_cnt, duplicated_cnt, issues
+
+
+def update_account_assets_history(account, start_date=None, verbse=False):
+    """根据交易记录更新账户的持仓快照
+
+    指定 `start_date` 时，从该日期之前最近一次的持仓快照开始只重放之后的交易，
+    找不到这样的快照时退化为完整重建。
+    """
+    code2amount, code2cost = defaultdict(float), defaultdict(float)
+    search = Deal.select(Deal.time, Deal.asset, Deal.action, Deal.amount, Deal.money).\
+        where(Deal.account == account)
+    if start_date:
+        base_date = AccountAssetsHistory.select(fn.MAX(AccountAssetsHistory.date)).\
+            where(AccountAssetsHistory.account == account).\
+            where(AccountAssetsHistory.date < start_date).\
+            scalar()
+        if base_date is None:
+            start_date = None
+        else:
+            base_search = AccountAssetsHistory.select().\
+                where(AccountAssetsHistory.account == account).\
+                where(AccountAssetsHistory.date == base_date)
+            for record in base_search:
+                code2amount[record.asset_id] = record.amount
+                code2cost[record.asset_id] = record.cost or 0.0
+
+            search = search.where(Deal.time >= datetime.combine(start_date, datetime.min.time()))
+
+    # 先在内存中得到所有交易日期上的持仓快照
+    snapshots = {}
+    deals = search.order_by(Deal.time).tuples()
+    for date, date_deals in groupby(deals, key=lambda item: item[0].date()):
+        for _, code, action, amount, money in date_deals:
             if action in ('buy', 'reinvest', 'transfer_in'):
-                code2amount[code] += item.amount
+                code2amount[code] += amount
                 if action == 'buy':
-                    code2amount['CASH'] -= item.money
-                    code2cost[code] += item.money
+                    code2amount['CASH'] -= money
+                    code2cost[code] += money
             elif action in ('sell', 'transfer_out'):
-                code2amount[code] -= item.amount
+                code2amount[code] -= amount
                 if action == 'sell':
-                    code2amount['CASH'] += item.money
-                    code2cost[code] -= item.money
+                    code2amount['CASH'] += money
+                    code2cost[code] -= money
             elif action in ('bonus', 'fix_cash'):
-                code2amount['CASH'] += item.amount
+                code2amount['CASH'] += amount
             elif action == 'spin_off':
-                code2amount[code] = item.amount
+                code2amount[code] = amount
 
         for code, amount in code2amount.items():
-            record = AccountAssetsHistory.get_or_none(
-                account=account, date=date, asset=code2asset[code]
-            )
-            created_or_updated = False
-            if not record:
-                AccountAssetsHistory.create(
-                    account=account,
-                    date=date,
-                    asset=code2asset[code],
-                    amount=code2amount[code],
-                    cost=code2cost[code] if code != 'CASH' else None
-                )
-                created_cnt += 1
-                created_or_updated = True
-            elif record.amount != code2amount[code]:
-                record.amount = code2amount[code]
-                record.cost = code2cost[code]
-                record.save()
-                update_cnt += 1
-                created_or_updated = True
-
-            if verbse and created_or_updated and (created_cnt + update_cnt) % 100 == 0:
+            snapshots[(date, code)] = (amount, code2cost[code] if code != 'CASH' else None)
+
+    # 再与数据库中已有的快照比较，只写入有变化的部分
+    search = AccountAssetsHistory.select(
+        AccountAssetsHistory.date,
+        AccountAssetsHistory.asset,
+        AccountAssetsHistory.amount,
+        AccountAssetsHistory.cost,
+    ).where(AccountAssetsHistory.account == account)
+    if start_date:
+        search = search.where(AccountAssetsHistory.date >= start_date)
+
+    existing = {(date, code): (amount, cost) for date, code, amount, cost in search.tuples()}
+    rows = []
+    for (date, code), (amount, cost) in snapshots.items():
+        if existing.get((date, code)) != (amount, cost):
+            rows.append({
+                'account': account,
+                'date': date,
+                'asset': code,
+                'amount': amount,
+                'cost': cost,
+            })
+
+    stale = defaultdict(list)
+    for date, code in existing.keys() - snapshots.keys():
+        stale[date].append(code)
+
+    with DATABASE.atomic():
+        for idx, batch in enumerate(chunked(rows, 100)):
+            AccountAssetsHistory.insert_many(batch).on_conflict(
+                conflict_target=[
+                    AccountAssetsHistory.account,
+                    AccountAssetsHistory.date,
+                    AccountAssetsHistory.asset,
+                ],
+                preserve=[AccountAssetsHistory.amount, AccountAssetsHistory.cost],
+            ).execute()
+            if verbse:
                 LOGGER.info(
-                    'created %d new assets history and updated %d records for account %s',
-                    created_cnt, update_cnt, account
+                    'wrote %d/%d assets history for account %s',
+                    min((idx + 1) * 100, len(rows)), len(rows), account
                 )
 
+        # 交易被删除或修改日期后，原日期上的持仓快照已经失效
+        for date, codes in stale.items():
+            AccountAssetsHistory.delete().\
+                where(AccountAssetsHistory.account == account).\
+                where(AccountAssetsHistory.date == date).\
+                where(AccountAssetsHistory.asset.in_(codes)).\
+                execute()
+
+    created_cnt = len(snapshots.keys() - existing.keys())
     LOGGER.info(
-        'created %d new assets history and updated %d records for account %s totally',
-        created_cnt, update_cnt, account
+        'created %d new assets history, updated %d and deleted %d records for account %s totally',
+        created_cnt, len(rows) - created_cnt, sum(map(len, stale.values())), account
     )
 
 
-def compute_account_history(account):
-    history = defaultdict(list)
-    search = AccountAssetsHistory.select().where(AccountAssetsHistory.account == account)
-    search = search.order_by(AccountAssetsHistory.date)
-    for record in search:
-        history[record.date].append(record)
+def get_price_matrix(account, codes, dates):
+    """构造 日期 × 资产 的价格矩阵，每个日期取当日及之前最近的价格
+
+    没有行情数据的资产使用账户内最近一次的买入价格，仍然没有则按 1.0 计算。
+    """
+    code2category = dict(
+        Asset.select(Asset.zs_code, Asset.category).where(Asset.zs_code.in_(codes)).tuples()
+    )
+    prices = pd.DataFrame(1.0, index=dates, columns=codes)
+    for code in codes:
+        if code == 'CASH' or code2category.get(code) == 'other':
+            continue
+
+        values = PRICE_BOOK.get_prices(code, dates)
+        missing = np.isnan(values)
+        if missing.any():
+            search = Deal.select(Deal.time, Deal.price).\
+                where(Deal.account == account).\
+                where(Deal.asset == code).\
+                where(Deal.action == 'buy').\
+                order_by(Deal.time)
+            buyings = list(search.tuples())
+            if buyings:
+                buying_dates = np.array([item[0].date() for item in buyings], dtype='datetime64[D]')
+                buying_prices = np.array([item[1] for item in buyings], dtype=float)
+                idx = np.searchsorted(
+                    buying_dates, np.asarray(dates, dtype='datetime64[D]'), side='right'
+                ) - 1
+                fallback = np.where(idx >= 0, buying_prices[np.maximum(idx, 0)], np.nan)
+                values = np.where(missing, fallback, values)
+
+            if np.isnan(values).any():
+                LOGGER.warning('no price found: %s', code)
+                values = np.where(np.isnan(values), 1.0, values)
+
+        prices[code] = values
+
+    return prices
+
+
+def compute_account_values(account, start_date=None):
+    """计算账户每个交易日的收益数据和各资产的市值
+
+    返回 (history, values)：history 每一项为 [日期, 总投入, 总金额, 净值, 现金, 仓位]，
+    values 每一项为 [日期, 资产代码, 份额, 价格, 市值, 投入, 浮动盈亏]，只包含持有的资产。
+    指定 `start_date` 时只计算该日期及之后的数据。
+    """
+    search = AccountAssetsHistory.select(
+        AccountAssetsHistory.date,
+        AccountAssetsHistory.asset,
+        AccountAssetsHistory.amount,
+        AccountAssetsHistory.cost,
+    ).where(AccountAssetsHistory.account == account)
+    if start_date:
+        base_date = AccountAssetsHistory.select(fn.MAX(AccountAssetsHistory.date)).\
+            where(AccountAssetsHistory.account == account).\
+            where(AccountAssetsHistory.date <= start_date).\
+            scalar()
+        if base_date is not None:
+            search = search.where(AccountAssetsHistory.date >= base_date)
+
+    snapshots = pd.DataFrame(list(search.tuples()), columns=['date', 'code', 'amount', 'cost'])
+    if snapshots.empty:
+        return [], []
+
+    first_date = snapshots['date'].min()
+    if start_date:
+        first_date = max(first_date, start_date)
 
-    first_date = min(history.keys())
     end_date = datetime.now().date()
     if datetime.now().hour < 20:
         end_date -= timedelta(days=1)
 
-    code2amount, results = {}, []
-    for offset in range((end_date - first_date).days + 1):
-        date = first_date + timedelta(days=offset)
-        if date in history:
-            code2amount = {}
-            for record in history[date]:
-                code2amount[record.asset.zs_code] = record.amount
+    # 交易日历只按节假日判断，还没有行情数据的日期不计算，避免产生沿用旧价格的记录
+    last_market_date = AssetMarketHistory.select(fn.MAX(AssetMarketHistory.date)).scalar()
+    if last_market_date is None:
+        return [], []
+
+    end_date = min(end_date, last_market_date)
+    dates = pd.date_range(first_date, end_date, freq='D')
+    if len(dates) == 0:
+        return [], []
+
+    # 持仓快照只在有交易的日期存在，快照中没有的资产视为不再持有，
+    # 两次快照之间的日期沿用前一次快照的持仓
+    holdings = snapshots.pivot(index='date', columns='code', values='amount').fillna(0.0)
+    holdings.index = pd.to_datetime(holdings.index)
+    holdings = holdings.reindex(dates, method='ffill').fillna(0.0)
+    holdings = holdings.where(holdings.abs() > 0.00001, 0.0)
+
+    costs = snapshots.pivot(index='date', columns='code', values='cost').\
+        astype(float).fillna(0.0)
+    costs.index = pd.to_datetime(costs.index)
+    costs = costs.reindex(dates, method='ffill').fillna(0.0)
+
+    prices = get_price_matrix(account, list(holdings.columns), dates)
+    values = holdings * prices
+    money = values.sum(axis=1)
+    cash = holdings['CASH'] if 'CASH' in holdings.columns else pd.Series(0.0, index=dates)
+
+    invested = pd.Series(CashFlowLedger.load([account]).get_invested_series(dates), index=dates)
+    nav = (money / invested.where(invested != 0)).fillna(1.0)
+    position = (1 - cash / money.where(money.abs() > 0.0001)).fillna(0.0)
+
+    # 忽略非交易日
+    mask = TRADING_CALENDAR.trading_mask(dates)
+
+    history = [
+        list(row)
+        for row in zip(
+            dates[mask].date,
+            invested[mask].round(2).tolist(),
+            money[mask].round(2).tolist(),
+            nav[mask].round(4).tolist(),
+            cash[mask].round(2).tolist(),
+            position[mask].round(4).tolist(),
+        )
+    ]
+
+    # 宽表转为 (日期, 资产) 的长表，只保留持有的资产
+    held = holdings[mask].stack()
+    held = held[held != 0]
+    index = held.index
+    amount = held.to_numpy()
+    price = prices[mask].stack()[index].to_numpy()
+    value = values[mask].stack()[index].round(2).to_numpy()
+    cost = costs[mask].stack()[index].round(2).to_numpy()
+    is_cash = index.get_level_values(1) == 'CASH'
+    asset_values = [
+        [
+            row_date, code, row_amount, row_price, row_money,
+            None if cash_flag else row_cost,
+            None if cash_flag else round(row_money - row_cost, 2),
+        ]
+        for row_date, code, row_amount, row_price, row_money, row_cost, cash_flag in zip(
+            index.get_level_values(0).date, index.get_level_values(1),
+            amount.tolist(), price.tolist(), value.tolist(), cost.tolist(), is_cash,
+        )
+    ]
+
+    return history, asset_values
+
+
+def compute_account_history(account, start_date=None):
+    """计算账户每个交易日的总投入、总金额、净值、现金和仓位
+
+    指定 `start_date` 时只计算该日期及之后的数据。
+    """
+    return compute_account_values(account, start_date=start_date)[0]
+
+
+def update_account_history(account, start_date=None):
+    """重新计算账户在 `start_date` 及之后的收益历史和各资产市值并写入数据库"""
+    history, asset_values = compute_account_values(account, start_date=start_date)
+    created_cnt, update_cnt = 0, 0
+    with DATABASE.atomic():
+        for item in history:
+            record = AccountHistory.get_or_none(account=account, date=item[0])
+            if not record:
+                AccountHistory.create(
+                    account=account,
+                    date=item[0],
+                    amount=item[1],
+                    money=item[2],
+                    nav=item[3],
+                    cash=item[4],
+                    position=item[5],
+                )
+                created_cnt += 1
+            elif record.amount != item[1] or record.money != item[2]:
+                record.amount = item[1]
+                record.money = item[2]
+                record.nav = item[3]
+                record.cash = item[4]
+                record.position = item[5]
+                record.save()
+                update_cnt += 1
 
-        total_money = 0.0
-        for code, amount in code2amount.items():
-            if abs(amount) <= 0.00001:
-                continue
+        # 交易被删除或起始日期推后时，重新计算的范围之外会留下旧记录
+        search = AccountHistory.delete().where(AccountHistory.account == account)
+        if start_date:
+            search = search.where(AccountHistory.date >= start_date)
+        if history:
+            search = search.where(
+                (AccountHistory.date < history[0][0]) | (AccountHistory.date > history[-1][0])
+            )
+        removed_cnt = search.execute()
 
-            if code == 'CASH':
-                total_money += amount
-                continue
+        # 资产市值按重新计算的范围整体替换
+        search = AccountAssetValueHistory.delete().\
+            where(AccountAssetValueHistory.account == account)
+        if start_date:
+            search = search.where(AccountAssetValueHistory.date >= start_date)
+        search.execute()
+
+        fields = [
+            AccountAssetValueHistory.date,
+            AccountAssetValueHistory.asset,
+            AccountAssetValueHistory.amount,
+            AccountAssetValueHistory.price,
+            AccountAssetValueHistory.money,
+            AccountAssetValueHistory.cost,
+            AccountAssetValueHistory.profit,
+            AccountAssetValueHistory.account,
+        ]
+        for batch in chunked(asset_values, 100):
+            rows = [item + [account] for item in batch]
+            AccountAssetValueHistory.insert_many(rows, fields=fields).execute()
 
-            asset = Asset.get(zs_code=code)
-            price = 1.0
-            price_record = asset.history.\
-                where(AssetMarketHistory.date <= date).\
-                order_by(AssetMarketHistory.date.desc()).\
-                first()
-            if not price_record and asset.category != 'other':
-                buying_records = asset.get_buying_records(account, date)
-                if buying_records:
-                    price = buying_records[-1].price
-                else:
-                    LOGGER.warning('no price found: %s', code)
-            elif price_record:
-                price = price_record.nav if code.endswith('OF') else price_record.close_price
-
-            total_money += amount * price
-
-        cash = code2amount.get('CASH', 0.0)
-        total_invested = Deal.get_total_invested(account, date=date)
-        # 忽略非交易日
-        if AssetMarketHistory.select().where(AssetMarketHistory.date == date).exists():
-            results.append([
-                date,
-                round(total_invested, 2),
-                round(total_money, 2),
-                round(total_money / total_invested, 4),
-                round(cash, 2),
-                round(1 - cash / total_money if abs(total_money) > 0.0001 else 0.0, 4),
-            ])
-
-    return results
+    LOGGER.info(
+        'created %d new history, update %d and removed %d record for account %s',
+        created_cnt, update_cnt, removed_cnt, account
+    )
+    LOGGER.info('saved %d asset value records for account %s', len(asset_values), account)
 
 
 def get_accounts_history(accounts, start_date=None, end_date=None):
-    data = []
-    summary = {}
-    for account in accounts:
-        search = AccountHistory.select().where(AccountHistory.account == account)
+    """多个账户在 [start_date, end_date] 内的每日数据，以及账户名为「总计」的每日汇总
+
+    返回 {列名: 列数据} 形式的列式数据，按账户和日期排序，可直接用于构造 DataFrame。
+    """
+    columns = ['account', 'date', 'amount', 'money', 'return', 'nav', 'cash', 'position']
+
+    def where(search):
+        search = search.where(AccountHistory.account.in_(list(accounts)))
         if start_date:
-            search = search.where(AssetMarketHistory.date >= start_date)
+            search = search.where(AccountHistory.date >= start_date)
         if end_date:
-            search = search.where(AssetMarketHistory.date <= start_date)
+            search = search.where(AccountHistory.date <= end_date)
 
-        for item in search.order_by(AccountHistory.date):
-            record = {
-                'account': item.account,
-                'date': item.date,
-                'amount': item.amount,
-                'money': item.money,
-                'return': round(item.money - item.amount, 2),
-                'nav': item.nav,
-                'cash': item.cash,
-                'position': item.position,
-            }
-            data.append(record)
-
-            date = record['date']
-            if record['date'] not in summary:
-                summary[date] = {
-                    'date': date,
-                    'amount': item.amount,
-                    'money': item.money,
-                    'cash': item.cash,
-                }
-            else:
-                summary[date]['amount'] += item.amount
-                summary[date]['money'] += item.money
-                summary[date]['cash'] += item.cash
-
-    for date, info in summary.items():
-        info['account'] = '总计'
-        info['return'] = round(info['money'] - info['amount'], 2)
-        info['nav'] = round(info['money'] / info['amount'], 4)
-        if info['money'] < 0.01:
-            info['position'] = 0
-        else:
-            info['position'] = round(1 - info['cash'] / info['money'], 4)
+        return search
 
-        info['amount'] = round(info['amount'], 2)
-        info['money'] = round(info['money'], 2)
-        data.append(info)
+    search = where(AccountHistory.select(
+        AccountHistory.account, AccountHistory.date, AccountHistory.amount,
+        AccountHistory.money, AccountHistory.nav, AccountHistory.cash, AccountHistory.position,
+    ))
+    details = pd.DataFrame(
+        list(search.tuples()),
+        columns=['account', 'date', 'amount', 'money', 'nav', 'cash', 'position']
+    )
+    details['return'] = (details['money'] - details['amount']).round(2)
+
+    search = where(AccountHistory.select(
+        AccountHistory.date,
+        fn.SUM(AccountHistory.amount),
+        fn.SUM(AccountHistory.money),
+        fn.SUM(AccountHistory.cash),
+    ))
+    summary = pd.DataFrame(
+        list(search.group_by(AccountHistory.date).tuples()),
+        columns=['date', 'amount', 'money', 'cash']
+    )
+    summary['account'] = '总计'
+    summary['return'] = (summary['money'] - summary['amount']).round(2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 总投入为 0 时与单个账户一样，净值记为 1
+        summary['nav'] = np.where(
+            summary['amount'].abs() > 0.0001, (summary['money'] / summary['amount']).round(4), 1.0
+        )
+        summary['position'] = np.where(
+            summary['money'] < 0.01, 0, (1 - summary['cash'] / summary['money']).round(4)
+        )
+
+    summary['amount'] = summary['amount'].round(2)
+    summary['money'] = summary['money'].round(2)
+
+    history = pd.concat([details[columns], summary[columns]], ignore_index=True)
+    history = history.sort_values(['account', 'date'], kind='mergesort')
+    return history.to_dict('list')
+
+
+def get_accounts_snapshots(accounts=None, dates=None):
+    """批量计算多个日期的账户汇总和持仓明细
+
+    返回 {date: (summary, assets)}，所有日期的数据一起查询和计算；某个日期没有记录时
+    summary 为 None。assets 按金额从大到小排序，`position` 为该资产占总资产的比例。
+    """
+    if not accounts:
+        accounts = [deal.account for deal in Deal.select(Deal.account).distinct()]
+
+    summaries = AccountHistory.get_summaries(accounts, dates)
+    assets_list = AccountAssetsHistory.get_assets_many(accounts, list(summaries))
+
+    snapshots = {}
+    for date, summary in summaries.items():
+        assets = assets_list[date]
+        assets.sort(key=itemgetter('money'), reverse=True)
+        total_money = summary['money'] if summary is not None else 0.0
+        for item in assets:
+            item['position'] = item['money'] / total_money if abs(total_money) > 0.001 else 0.0
+
+        snapshots[date] = (summary, assets)
 
-    data.sort(key=itemgetter('account', 'date'))
-    return pd.DataFrame(data)
+    return snapshots
 
 
 def get_accounts_summary(accounts=None, date=None):
@@ -249,11 +605,14 @@ def get_accounts_summary(accounts=None, date=None):
     if date is None:
         date = now.date() if now.hour >= 20 else now.date() - timedelta(days=1)
 
-    if not accounts:
-        accounts = [deal.account for deal in Deal.select(Deal.account).distinct()]
+    prev_date = date - timedelta(days=1)
+    snapshots = get_accounts_snapshots(accounts, [date, prev_date])
+    summary, assets = snapshots[date]
+    prev_summary, prev_assets = snapshots[prev_date]
+    if summary is None:
+        return None, []
 
-    summary = AccountHistory.get_summary(accounts, date)
-    prev_summary = AccountHistory.get_summary(accounts, date - timedelta(days=1))
+    summary.pop('details')
     if prev_summary is not None:
         summary['day_return'] = summary['return'] - prev_summary['return']
     else:
@@ -265,17 +624,7 @@ def get_accounts_summary(accounts=None, date=None):
     else:
         summary['day_return_rate'] = day_return / (summary['money'] - day_return)
 
-    assets = AccountAssetsHistory.get_assets(accounts, date)
-    assets.sort(key=itemgetter('money'), reverse=True)
-
-    total_money = summary['money']
-    for item in assets:
-        item['position'] = item['money'] / total_money if abs(total_money) > 0.001 else 0.0
-
-    prev_assets = {}
-    for item in AccountAssetsHistory.get_assets(accounts, date - timedelta(days=1)):
-        prev_assets[item['code']] = item
-
+    prev_assets = {item['code']: item for item in prev_assets}
     for item in assets:
         prev_item = prev_assets.get(item['code'])
         if prev_item is None or prev_item['return'] is None:
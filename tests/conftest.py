@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+
+# 测试使用单独的数据目录，避免读写用户的数据库
+os.environ['KEYSERSOZE_DB_DIR'] = tempfile.mkdtemp(prefix='keysersoze-test-')
@@ -0,0 +1,173 @@
+import time
+import threading
+
+import pytest
+from requests import HTTPError, Response, exceptions
+
+from keysersoze.fetcher import TokenBucket, Fetcher, is_transient_error
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeProvider:
+    """按顺序抛出 `errors` 中的异常，之后返回调用参数"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, value):
+        with self.lock:
+            self.calls += 1
+            if self.errors:
+                raise self.errors.pop(0)
+
+        return value
+
+
+def http_error(status_code):
+    resp = Response()
+    resp.status_code = status_code
+    return HTTPError(f'{status_code} error', response=resp)
+
+
+def make_fetcher(retries=3, sleeps=None):
+    def sleep(seconds):
+        if sleeps is not None:
+            sleeps.append(seconds)
+
+    return Fetcher({'fake': (60000, 100)}, max_workers=4, retries=retries, sleep=sleep)
+
+
+def test_token_bucket_waits_for_tokens():
+    clock = FakeClock()
+    bucket = TokenBucket(2, capacity=1, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        bucket.acquire()
+
+    # 第一个令牌立即可用，之后每 0.5 秒补充一个
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_token_bucket_allows_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(1, capacity=3, clock=clock, sleep=clock.sleep)
+    clock.now = 10.0
+    for _ in range(3):
+        bucket.acquire()
+
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.now == pytest.approx(11.0)
+
+
+def test_fetcher_limits_request_rate():
+    provider = FakeProvider()
+    fetcher = Fetcher({'fake': (1200, 1)}, max_workers=8)
+    jobs = [(idx, lambda idx=idx: fetcher.call('fake', provider, idx)) for idx in range(11)]
+
+    start = time.monotonic()
+    results = list(fetcher.run(jobs))
+    elapsed = time.monotonic() - start
+
+    # 每秒 20 个请求，11 个请求至少需要 0.5 秒
+    assert elapsed >= 0.45
+    assert sorted(key for key, _, _ in results) == list(range(11))
+    assert provider.calls == 11
+
+
+def test_fetcher_retries_transient_errors():
+    sleeps = []
+    provider = FakeProvider([exceptions.ConnectionError(), http_error(503), exceptions.Timeout()])
+    fetcher = make_fetcher(sleeps=sleeps)
+
+    assert fetcher.call('fake', provider, 'ok') == 'ok'
+    assert provider.calls == 4
+    assert len(sleeps) == 3
+    assert sleeps[0] < sleeps[1] < sleeps[2]
+
+
+def test_fetcher_gives_up_after_retries():
+    provider = FakeProvider([exceptions.ConnectionError()] * 5)
+    fetcher = make_fetcher(retries=2)
+
+    with pytest.raises(exceptions.ConnectionError):
+        fetcher.call('fake', provider, 'ok')
+
+    assert provider.calls == 3
+
+
+@pytest.mark.parametrize('error', [ValueError('bug'), KeyError('key'), http_error(404)])
+def test_fetcher_does_not_retry_other_errors(error):
+    provider = FakeProvider([error])
+    fetcher = make_fetcher()
+
+    with pytest.raises(type(error)):
+        fetcher.call('fake', provider, 'ok')
+
+    assert provider.calls == 1
+
+
+def test_is_transient_error():
+    assert is_transient_error(http_error(429))
+    assert is_transient_error(http_error(502))
+    assert is_transient_error(ConnectionResetError())
+    assert not is_transient_error(http_error(403))
+    assert not is_transient_error(exceptions.InvalidURL())
+    assert not is_transient_error(FileNotFoundError())
+
+
+def test_fetcher_retries_tushare_rate_limit():
+    sleeps = []
+    provider = FakeProvider([
+        Exception('抱歉，您每分钟最多访问该接口500次，权限的具体详情访问：https://tushare.pro/document/1?doc_id=108。'),
+    ])
+    fetcher = make_fetcher(sleeps=sleeps)
+
+    assert fetcher.call('fake', provider, 'ok') == 'ok'
+    assert provider.calls == 2
+    assert len(sleeps) == 1
+
+    # 每天的访问次数用完时重试也不会成功
+    provider = FakeProvider([Exception('抱歉，您每天最多访问该接口20000次')])
+    with pytest.raises(Exception, match='每天最多访问'):
+        fetcher.call('fake', provider, 'ok')
+
+    assert provider.calls == 1
+
+
+def test_fetcher_run_reports_errors():
+    providers = {
+        'ok': FakeProvider(),
+        'flaky': FakeProvider([exceptions.ConnectionError()]),
+        'broken': FakeProvider([ValueError('bad data')]),
+        'down': FakeProvider([http_error(500)] * 10),
+    }
+    fetcher = make_fetcher(retries=2)
+    jobs = [
+        (name, lambda name=name: fetcher.call('fake', providers[name], name))
+        for name in providers
+    ]
+
+    results = {key: (result, error) for key, result, error in fetcher.run(jobs)}
+
+    assert results['ok'] == ('ok', None)
+    assert results['flaky'] == ('flaky', None)
+    assert results['broken'][0] is None
+    assert isinstance(results['broken'][1], ValueError)
+    assert results['down'][0] is None
+    assert isinstance(results['down'][1], HTTPError)
+    assert providers['down'].calls == 3
@@ -0,0 +1,107 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from keysersoze.data import QiemanExporter
+
+
+ORDER_COUNT = 230
+
+
+class QiemanStub(BaseHTTPRequestHandler):
+    """按页返回订单列表、返回订单详情的且慢接口替身
+
+    越靠前的订单详情返回得越慢，使详情请求的完成顺序与订单顺序相反；
+    `failures` 中的订单详情会先返回指定次数的 503。
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    failures = {}
+    requests = []
+    completed = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith('/orders'):
+            page = int(parse_qs(url.query)['page'][0])
+            ids = range(page * 100, min(ORDER_COUNT, (page + 1) * 100))
+            body = {
+                'content': [
+                    {'orderId': str(idx), 'acceptTime': idx, 'hasDetail': idx % 3 != 0}
+                    for idx in ids
+                ],
+                'last': (page + 1) * 100 >= ORDER_COUNT,
+            }
+        else:
+            order_id = url.path.rsplit('/', 1)[1]
+            self.requests.append(order_id)
+            if self.failures.get(order_id):
+                self.failures[order_id] -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            time.sleep(max(0, 20 - int(order_id)) * 0.005)
+            self.completed.append(order_id)
+            body = {'orderId': order_id, 'acceptTime': int(order_id), 'detail': True}
+
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def exporter():
+    QiemanStub.failures, QiemanStub.requests, QiemanStub.completed = {}, [], []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), QiemanStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    exporter = QiemanExporter('aid', 'request-id', 'sign', 'token', max_workers=4)
+    exporter.BASE_URL = f'http://127.0.0.1:{server.server_port}'
+    yield exporter
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_list_orders_keeps_order(exporter):
+    orders = list(exporter.list_orders('CA1'))
+
+    assert [order['orderId'] for order in orders] == [str(idx) for idx in range(ORDER_COUNT)]
+    for order in orders:
+        assert order.get('detail', False) == (int(order['orderId']) % 3 != 0)
+
+    # 详情请求是并发执行的，完成顺序与订单顺序不同
+    assert len(QiemanStub.completed) == len([idx for idx in range(ORDER_COUNT) if idx % 3])
+    assert QiemanStub.completed != sorted(QiemanStub.completed, key=int)
+
+
+def test_list_orders_retries_server_errors(exporter):
+    QiemanStub.failures = {'1': 2, '5': 1}
+    orders = list(exporter.list_orders('CA1'))
+
+    assert [order['orderId'] for order in orders] == [str(idx) for idx in range(ORDER_COUNT)]
+    assert orders[1]['detail'] and orders[5]['detail']
+    assert QiemanStub.requests.count('1') == 3
+    assert QiemanStub.requests.count('5') == 2
+
+
+def test_list_orders_skips_exported(exporter):
+    exported = {str(idx) for idx in range(100, ORDER_COUNT)}
+    orders = list(exporter.list_orders('CA1', exported=exported, since=ORDER_COUNT))
+
+    assert [order['orderId'] for order in orders] == [str(idx) for idx in range(100)]
+    assert all(int(order_id) < 100 for order_id in QiemanStub.requests)
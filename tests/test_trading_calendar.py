@@ -0,0 +1,73 @@
+from datetime import date
+
+import pytest
+
+from keysersoze import trading_calendar
+from keysersoze.models import (
+    DATABASE,
+    Asset,
+    AssetMarketHistory,
+    CalendarDay,
+)
+from keysersoze.trading_calendar import TradingCalendar
+
+
+MODELS = [Asset, AssetMarketHistory, CalendarDay]
+
+
+def fake_is_holiday(cur_date):
+    """模拟节假日数据只覆盖到 2026 年"""
+    if cur_date.year >= 2027:
+        raise NotImplementedError(cur_date.year)
+
+    return False
+
+
+@pytest.fixture
+def calendar(monkeypatch):
+    monkeypatch.setattr(trading_calendar, 'is_holiday', fake_is_holiday)
+    DATABASE.create_tables(MODELS)
+    Asset.create(zs_code='000001.SH', code='000001', name='上证指数', category='index')
+    try:
+        yield TradingCalendar()
+    finally:
+        DATABASE.drop_tables(MODELS)
+
+
+def add_prices(*dates):
+    for cur_date in dates:
+        AssetMarketHistory.create(asset='000001.SH', date=cur_date, close_price=1.0)
+
+
+def saved_dates():
+    return [item.date for item in CalendarDay.select().order_by(CalendarDay.date)]
+
+
+def test_update_stops_at_latest_market_date_for_uncovered_years(calendar):
+    add_prices(date(2026, 12, 31))
+    calendar.save(date(2026, 12, 28), date(2026, 12, 31))
+
+    # 2027-01-04 运行时还没有当天的行情，没有节假日数据的日期都不保存
+    calendar.update(end_date=date(2027, 12, 31))
+    assert saved_dates()[-1] == date(2026, 12, 31)
+
+    add_prices(date(2027, 1, 4), date(2027, 1, 5))
+    calendar.update(end_date=date(2027, 12, 31))
+    assert saved_dates()[-1] == date(2027, 1, 5)
+    assert calendar.is_trading_day(date(2027, 1, 4))
+    assert calendar.is_trading_day(date(2027, 1, 5))
+    assert not calendar.is_trading_day(date(2027, 1, 1))
+
+
+def test_update_recomputes_uncovered_year(calendar):
+    add_prices(date(2026, 12, 31), date(2027, 1, 4))
+    calendar.save(date(2026, 12, 28), date(2027, 12, 31))
+    assert saved_dates()[-1] == date(2027, 1, 4)
+    assert calendar.get_update_start_date() == date(2027, 1, 1)
+
+    # 之前保存的日期即使已经有了结果，也会随着行情数据的补充重新计算
+    CalendarDay.update(is_trading=False).where(CalendarDay.date == date(2027, 1, 4)).execute()
+    add_prices(date(2027, 1, 5), date(2027, 1, 6))
+    calendar.update(end_date=date(2027, 12, 31))
+    assert saved_dates()[-1] == date(2027, 1, 6)
+    assert all(calendar.is_trading_day(date(2027, 1, day)) for day in (4, 5, 6))